@@ -0,0 +1,313 @@
+#! /usr/bin/env python
+"""Benchmark the slide copy path on synthetic decks.
+
+The decks are generated offline with a configurable number of slides and,
+per slide, images, charts (each with style, colors and an xlsx workbook),
+oleObjects and vmlDrawings (each relating to an image of its own). The
+parts only carry what the copy path looks at - relationships and content
+types - plus filler bytes of a realistic size; they are not meant to be
+opened in PowerPoint.
+
+Scenarios:
+    single   one slide copied into a fresh copy of the target, repeatedly
+    batch    all copies applied with one copy_slides() call
+    growing  one slide appended per call to a target that keeps growing;
+             per-call times are kept so superlinear growth shows up, and
+             last_to_first compares the median of the last calls to that
+             of the first ones
+
+Only the copy_slides() calls are timed, not copying the target beforehand.
+Results (seconds, slides/s, peak resident memory) are written as JSON so
+runs can be compared.
+"""
+import os, sys, json, time, shutil, tempfile, zipfile
+from random import Random
+from statistics import median
+
+from copy_slide import CopyTrace, PeakRSS, copy_slides
+
+NS = {
+    'p': 'http://schemas.openxmlformats.org/presentationml/2006/main',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'c': 'http://schemas.openxmlformats.org/drawingml/2006/chart',
+}
+RT = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+MS_RT = 'http://schemas.microsoft.com/office/2011/relationships/'
+CT = 'application/vnd.openxmlformats-officedocument.'
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+
+def rels_xml(relationships):
+    return XML_HEADER + (
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' +
+        ''.join('<Relationship Id="rId{}" Type="{}" Target="{}"/>'.format(
+                    index + 1, kind if '://' in kind else RT + kind, target)
+                for index, (kind, target) in enumerate(relationships)) +
+        '</Relationships>'
+    )
+
+
+def slide_xml(pictures, charts):
+    shapes = []
+    for index, rid in enumerate(pictures):
+        shapes.append(
+            '<p:pic><p:nvPicPr><p:cNvPr id="{0}" name="Picture {0}"/><p:cNvPicPr/><p:nvPr/></p:nvPicPr>'
+            '<p:blipFill><a:blip r:embed="{1}"/><a:stretch><a:fillRect/></a:stretch></p:blipFill>'
+            '<p:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="914400" cy="914400"/></a:xfrm>'
+            '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></p:spPr></p:pic>'.format(index + 2, rid))
+    for index, rid in enumerate(charts):
+        shapes.append(
+            '<p:graphicFrame><p:nvGraphicFramePr><p:cNvPr id="{0}" name="Chart {0}"/><p:cNvGraphicFramePr/><p:nvPr/>'
+            '</p:nvGraphicFramePr><p:xfrm><a:off x="0" y="0"/><a:ext cx="914400" cy="914400"/></p:xfrm>'
+            '<a:graphic><a:graphicData uri="{1}"><c:chart r:id="{2}"/></a:graphicData></a:graphic>'
+            '</p:graphicFrame>'.format(len(pictures) + index + 2, NS['c'], rid))
+    return XML_HEADER + (
+        '<p:sld xmlns:a="{a}" xmlns:r="{r}" xmlns:p="{p}" xmlns:c="{c}"><p:cSld><p:spTree>'
+        '<p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/><p:nvPr/></p:nvGrpSpPr><p:grpSpPr/>'
+        '{shapes}</p:spTree></p:cSld></p:sld>'.format(shapes=''.join(shapes), **NS)
+    )
+
+
+def filler(random, size):
+    """*size* incompressible bytes."""
+    return random.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+
+def make_deck(path, slides=10, images=2, charts=1, ole_objects=0, vml_drawings=0,
+              image_size=64 * 1024, seed=0):
+    """Write a synthetic deck with the given number of parts per slide."""
+    random = Random(seed)
+    counters = dict.fromkeys(['image', 'chart', 'oleObject', 'vmlDrawing'], 0)
+    overrides = []
+    parts = []
+
+    def next_id(kind):
+        counters[kind] += 1
+        return counters[kind]
+
+    def image():
+        number = next_id('image')
+        # Incompressible filler behind a PNG signature, like real media.
+        data = b'\x89PNG\r\n\x1a\n' + filler(random, image_size)
+        parts.append(('ppt/media/image{}.png'.format(number), data))
+        return 'image{}.png'.format(number)
+
+    for slide in range(1, slides + 1):
+        relationships = [('slideLayout', '../slideLayouts/slideLayout1.xml')]
+        pictures = []
+        chart_rids = []
+        for _ in range(images):
+            relationships.append(('image', '../media/' + image()))
+            pictures.append('rId{}'.format(len(relationships)))
+        for _ in range(charts):
+            number = next_id('chart')
+            parts.append(('ppt/charts/chart{}.xml'.format(number), XML_HEADER +
+                          '<c:chartSpace xmlns:c="{c}" xmlns:r="{r}"><c:chart/>'
+                          '<c:externalData r:id="rId3"/></c:chartSpace>'.format(**NS)))
+            parts.append(('ppt/charts/style{}.xml'.format(number), XML_HEADER +
+                          '<cs:chartStyle xmlns:cs="http://schemas.microsoft.com/office/drawing/2012/chartStyle" id="201"/>'))
+            parts.append(('ppt/charts/colors{}.xml'.format(number), XML_HEADER +
+                          '<cs:colorStyle xmlns:cs="http://schemas.microsoft.com/office/drawing/2012/chartStyle" meth="cycle" id="10"/>'))
+            parts.append(('ppt/embeddings/Microsoft_Excel_Worksheet{}.xlsx'.format(number),
+                          filler(random, 8 * 1024)))
+            parts.append(('ppt/charts/_rels/chart{}.xml.rels'.format(number), rels_xml([
+                (MS_RT + 'chartStyle', 'style{}.xml'.format(number)),
+                (MS_RT + 'chartColorStyle', 'colors{}.xml'.format(number)),
+                ('package', '../embeddings/Microsoft_Excel_Worksheet{}.xlsx'.format(number)),
+            ])))
+            overrides.extend([
+                ('/ppt/charts/chart{}.xml'.format(number), CT + 'drawingml.chart+xml'),
+                ('/ppt/charts/style{}.xml'.format(number), 'application/vnd.ms-office.chartstyle+xml'),
+                ('/ppt/charts/colors{}.xml'.format(number), 'application/vnd.ms-office.chartcolorstyle+xml'),
+            ])
+            relationships.append(('chart', '../charts/chart{}.xml'.format(number)))
+            chart_rids.append('rId{}'.format(len(relationships)))
+        for _ in range(ole_objects):
+            number = next_id('oleObject')
+            parts.append(('ppt/embeddings/oleObject{}.bin'.format(number),
+                          filler(random, 16 * 1024)))
+            relationships.append(('oleObject', '../embeddings/oleObject{}.bin'.format(number)))
+        for _ in range(vml_drawings):
+            number = next_id('vmlDrawing')
+            parts.append(('ppt/drawings/vmlDrawing{}.vml'.format(number),
+                          '<xml xmlns:v="urn:schemas-microsoft-com:vml"><v:shape id="s{}"/></xml>'.format(number)))
+            parts.append(('ppt/drawings/_rels/vmlDrawing{}.vml.rels'.format(number),
+                          rels_xml([('image', '../media/' + image())])))
+            relationships.append(('vmlDrawing', '../drawings/vmlDrawing{}.vml'.format(number)))
+        parts.append(('ppt/slides/slide{}.xml'.format(slide), slide_xml(pictures, chart_rids)))
+        parts.append(('ppt/slides/_rels/slide{}.xml.rels'.format(slide), rels_xml(relationships)))
+        overrides.append(('/ppt/slides/slide{}.xml'.format(slide), CT + 'presentationml.slide+xml'))
+
+    presentation_rels = [('slideMaster', 'slideMasters/slideMaster1.xml'), ('theme', 'theme/theme1.xml')]
+    presentation_rels.extend(('slide', 'slides/slide{}.xml'.format(slide)) for slide in range(1, slides + 1))
+    presentation = XML_HEADER + (
+        '<p:presentation xmlns:a="{a}" xmlns:r="{r}" xmlns:p="{p}">'
+        '<p:sldMasterIdLst><p:sldMasterId id="2147483648" r:id="rId1"/></p:sldMasterIdLst>'
+        '<p:sldIdLst>{slides}</p:sldIdLst><p:sldSz cx="9144000" cy="6858000"/>'
+        '<p:notesSz cx="6858000" cy="9144000"/></p:presentation>'
+    ).format(slides=''.join('<p:sldId id="{}" r:id="rId{}"/>'.format(255 + slide, slide + 2)
+                            for slide in range(1, slides + 1)), **NS)
+    overrides.extend([
+        ('/ppt/presentation.xml', CT + 'presentationml.presentation.main+xml'),
+        ('/ppt/slideMasters/slideMaster1.xml', CT + 'presentationml.slideMaster+xml'),
+        ('/ppt/slideLayouts/slideLayout1.xml', CT + 'presentationml.slideLayout+xml'),
+        ('/ppt/theme/theme1.xml', CT + 'theme+xml'),
+    ])
+    content_types = XML_HEADER + (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Default Extension="png" ContentType="image/png"/>'
+        '<Default Extension="bin" ContentType="' + CT + 'oleObject"/>'
+        '<Default Extension="vml" ContentType="' + CT + 'vmlDrawing"/>'
+        '<Default Extension="xlsx" ContentType="' + CT + 'spreadsheetml.sheet"/>' +
+        ''.join('<Override PartName="{}" ContentType="{}"/>'.format(name, content_type)
+                for name, content_type in overrides) +
+        '</Types>'
+    )
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as deck:
+        deck.writestr('[Content_Types].xml', content_types)
+        deck.writestr('_rels/.rels', rels_xml([('officeDocument', 'ppt/presentation.xml')]))
+        deck.writestr('ppt/presentation.xml', presentation)
+        deck.writestr('ppt/_rels/presentation.xml.rels', rels_xml(presentation_rels))
+        deck.writestr('ppt/slideMasters/slideMaster1.xml', XML_HEADER +
+                      '<p:sldMaster xmlns:r="{r}" xmlns:p="{p}"><p:cSld><p:spTree/></p:cSld>'
+                      '<p:sldLayoutIdLst><p:sldLayoutId id="2147483649" r:id="rId1"/></p:sldLayoutIdLst>'
+                      '</p:sldMaster>'.format(**NS))
+        deck.writestr('ppt/slideMasters/_rels/slideMaster1.xml.rels', rels_xml([
+            ('slideLayout', '../slideLayouts/slideLayout1.xml'), ('theme', '../theme/theme1.xml')]))
+        deck.writestr('ppt/slideLayouts/slideLayout1.xml', XML_HEADER +
+                      '<p:sldLayout xmlns:p="{p}"><p:cSld name="Blank"><p:spTree/></p:cSld>'
+                      '</p:sldLayout>'.format(**NS))
+        deck.writestr('ppt/slideLayouts/_rels/slideLayout1.xml.rels', rels_xml([
+            ('slideMaster', '../slideMasters/slideMaster1.xml')]))
+        deck.writestr('ppt/theme/theme1.xml', XML_HEADER +
+                      '<a:theme xmlns:a="{a}" name="Office Theme"/>'.format(**NS))
+        for name, data in parts:
+            deck.writestr(name, data)
+
+
+def measure(run, memory=True):
+    """Seconds *run* spends copying and, with *memory*, the peak resident memory meanwhile.
+
+    *run* returns the seconds its copy_slides() calls took, so preparing
+    the decks is not counted. The peak is that of the whole process, so
+    what libxml2 and zlib allocate counts too, and reading it costs
+    nothing: *run* runs once. It is None where the peak cannot be
+    restarted per run (see copy_slide.reset_peak_rss()).
+    """
+    if not memory:
+        return run(), None
+    with PeakRSS() as rss:
+        seconds = run()
+    return seconds, rss.peak
+
+
+def timed(calls, *args, **kwargs):
+    """Call copy_slides(*args, **kwargs) and append the seconds it took to *calls*."""
+    start = time.time()
+    copy_slides(*args, **kwargs)
+    calls.append(time.time() - start)
+
+
+def growth(calls, count=5):
+    """Median of the last *count* call times over that of the first *count*.
+
+    Medians keep one slow call (the first one also reads and indexes the
+    source) from deciding the ratio; fewer calls are compared when there
+    are less than 2 * *count*.
+    """
+    count = min(count, len(calls) // 2)
+    if not count:
+        return None
+    first, last = median(calls[:count]), median(calls[-count:])
+    return last / first if first else None
+
+
+def run_benchmark(folder, copies=20, memory=True, **deck_options):
+    """Run every scenario on decks generated in *folder*; return the results."""
+    source_path = os.path.join(folder, 'source.pptx')
+    target_path = os.path.join(folder, 'target.pptx')
+    output_path = os.path.join(folder, 'output.pptx')
+    make_deck(source_path, seed=1, **deck_options)
+    make_deck(target_path, seed=2, **deck_options)
+    slide_count = deck_options.get('slides', 10)
+    slides = [(source_path, index % slide_count + 1) for index in range(copies)]
+    results = {}
+
+    def single():
+        calls = []
+        for copy in slides:
+            shutil.copyfile(target_path, output_path)
+            timed(calls, output_path, [copy])
+        return sum(calls)
+    seconds, peak = measure(single, memory)
+    results['single'] = {'slides': copies, 'seconds': seconds, 'peak_rss': peak}
+
+    traces = []
+
+    def batch():
+        calls = []
+        shutil.copyfile(target_path, output_path)
+        traces.append(CopyTrace())
+        timed(calls, output_path, slides, trace=traces[-1])
+        return sum(calls)
+    seconds, peak = measure(batch, memory)
+    results['batch'] = {'slides': copies, 'seconds': seconds, 'peak_rss': peak,
+                        'trace': traces[0].report()}
+
+    calls = []
+
+    def growing():
+        shutil.copyfile(target_path, output_path)
+        for copy in slides:
+            timed(calls, output_path, [copy])
+        return sum(calls)
+    seconds, peak = measure(growing, memory)
+    results['growing'] = {'slides': copies, 'seconds': seconds, 'peak_rss': peak,
+                          'call_seconds': calls,
+                          # Well above 1 means the cost per copy grows with the target.
+                          'last_to_first': growth(calls)}
+
+    for result in results.values():
+        result['slides_per_second'] = result['slides'] / result['seconds'] if result['seconds'] else None
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark slide copies on synthetic decks.")
+    parser.add_argument('--slides', type=int, default=10, help="slides per deck")
+    parser.add_argument('--images', type=int, default=2, help="images per slide")
+    parser.add_argument('--charts', type=int, default=1, help="charts per slide")
+    parser.add_argument('--ole-objects', type=int, default=1, help="oleObjects per slide")
+    parser.add_argument('--vml-drawings', type=int, default=1, help="vmlDrawings per slide")
+    parser.add_argument('--image-size', type=int, default=64 * 1024, help="bytes per image")
+    parser.add_argument('--copies', type=int, default=20, help="slides copied per scenario")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="do not report the peak resident memory")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    config = {
+        'slides': args.slides, 'images': args.images, 'charts': args.charts,
+        'ole_objects': args.ole_objects, 'vml_drawings': args.vml_drawings,
+        'image_size': args.image_size,
+    }
+    folder = tempfile.mkdtemp(prefix='copy_slide_bench_')
+    try:
+        results = run_benchmark(folder, args.copies, not args.no_memory, **config)
+    finally:
+        shutil.rmtree(folder)
+    report = {'config': dict(config, copies=args.copies), 'python': sys.version.split()[0],
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    for name, result in results.items():
+        print("{:8} {:4} slides {:8.3f}s {:8.1f} slides/s  peak {}".format(
+            name, result['slides'], result['seconds'], result['slides_per_second'] or 0,
+            'n/a' if result['peak_rss'] is None
+            else '{:.1f} MB'.format(result['peak_rss'] / 1024.0 / 1024.0)))
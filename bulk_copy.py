@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+"""Assemble many decks at once from a manifest of slide copies.
+
+Every job of the manifest copies one slide of a source deck to the end of
+a target deck. The jobs of one target are merged into a single
+copy_slides() rewrite and run in manifest order; different targets are
+spread over a process pool; each target is held under its TargetLock
+while it is rewritten, so other runs can update it safely. A failing job does not take the rest of its
+target down with it: the target's jobs are then retried one by one, so
+only the failing ones are reported and skipped. The peak resident memory
+of every target is reported; with a memory budget, the copies of each
+worker are kept within it (see copy_slide.MemoryBudget).
+
+Manifest formats:
+    JSON: [{"target": "B.pptx", "source": "A.pptx", "slide": 3}, ...]
+    CSV:  target,source,slide header followed by one job per row
+"""
+import os, sys, csv, json, time, traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from copy_slide import MemoryBudget, PackageCache, PeakRSS, copy_slides
+
+# Source decks stay open in each worker process between targets.
+_cache = None
+
+
+def read_manifest(path):
+    """The jobs of manifest *path* as a list of ``(target, source, slide)``."""
+    with open(path) as file:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = json.load(file)
+    return [(row['target'], row['source'], int(row['slide'])) for row in rows]
+
+
+def _copy_target(target_path, jobs, dedup, index_dir, memory_budget=None, verify=False):
+    """Run the ``(job number, source, slide)`` *jobs* of one target.
+
+    Returns the result of every job, the seconds taken and the peak
+    resident memory of the worker while running them (None where it
+    cannot be measured per target).
+    """
+    global _cache
+    if _cache is None:
+        _cache = PackageCache(index_dir=index_dir)
+    memory = MemoryBudget(memory_budget) if memory_budget else None
+
+    start = time.time()
+    with PeakRSS() as rss:
+        try:
+            copy_slides(target_path, [(source, slide) for number, source, slide in jobs],
+                        dedup, cache=_cache, memory=memory, lock=True, verify=verify)
+            results = [(number, None) for number, source, slide in jobs]
+        except Exception:
+            # copy_slides writes nothing when it fails, so each job can be
+            # retried on its own to find the one(s) at fault.
+            results = []
+            for number, source, slide in jobs:
+                try:
+                    copy_slides(target_path, [(source, slide)], dedup, cache=_cache, memory=memory,
+                                lock=True, verify=verify)
+                    results.append((number, None))
+                except Exception:
+                    results.append((number, traceback.format_exc()))
+    return results, time.time() - start, rss.peak
+
+
+def run_jobs(jobs, workers=None, dedup=False, index_dir=None, memory_budget=None,
+             verify=False):
+    """Run the ``(target, source, slide)`` *jobs* and return a report dict.
+
+    The report holds one entry per job (in manifest order) with its error,
+    if any, the time and peak resident memory of each target, and a
+    summary with the job, failure and target counts, the wall time, the
+    throughput and the largest peak. *memory_budget* is the resident
+    memory, in bytes, each worker keeps its copies within. With *verify*,
+    a job whose copy fails copy_slide.verify_parts() is reported as failed.
+    """
+    targets = OrderedDict()
+    for number, (target_path, source, slide) in enumerate(jobs):
+        targets.setdefault(os.path.abspath(target_path), []).append((number, source, slide))
+
+    start = time.time()
+    errors = {}
+    target_seconds = OrderedDict()
+    target_peaks = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = OrderedDict(
+            (target_path, executor.submit(_copy_target, target_path, target_jobs, dedup,
+                                          index_dir, memory_budget, verify))
+            for target_path, target_jobs in targets.items()
+        )
+        for target_path, future in futures.items():
+            try:
+                results, target_seconds[target_path], target_peaks[target_path] = future.result()
+            except Exception:
+                # The worker itself died; every job of its target failed.
+                error = traceback.format_exc()
+                results = [(number, error) for number, source, slide in targets[target_path]]
+                target_seconds[target_path] = None
+                target_peaks[target_path] = None
+            for number, error in results:
+                if error is not None:
+                    errors[number] = error
+    seconds = time.time() - start
+
+    bytes_written = sum(os.path.getsize(target_path) for target_path in targets
+                        if os.path.exists(target_path))
+    return {
+        'jobs': [
+            {'target': target_path, 'source': source, 'slide': slide,
+             'ok': number not in errors, 'error': errors.get(number),
+             'peak_rss': target_peaks[os.path.abspath(target_path)]}
+            for number, (target_path, source, slide) in enumerate(jobs)
+        ],
+        'targets': [
+            {'target': target_path, 'seconds': seconds, 'peak_rss': target_peaks[target_path]}
+            for target_path, seconds in target_seconds.items()
+        ],
+        'summary': {
+            'jobs': len(jobs),
+            'failed': len(errors),
+            'targets': len(targets),
+            'seconds': seconds,
+            'jobs_per_second': len(jobs) / seconds if seconds else 0.0,
+            'bytes_written': bytes_written,
+            'peak_rss': max([peak for peak in target_peaks.values() if peak is not None] or [None]),
+        },
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the slide copies of a manifest.")
+    parser.add_argument('manifest', help="JSON or CSV manifest of target/source/slide jobs")
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="share media/embeddings identical to ones already in a target")
+    parser.add_argument('--index-dir',
+                        help="cache the dependency index of every source deck in this folder")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help="resident memory each worker keeps its copies within")
+    parser.add_argument('--verify', action='store_true',
+                        help="check the parts each copy touched before writing its target")
+    parser.add_argument('--report', help="write the full JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_jobs(read_manifest(args.manifest), args.workers, args.dedup, args.index_dir,
+                      int(args.memory_budget * 1048576) if args.memory_budget else None,
+                      args.verify)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+    for job in report['jobs']:
+        if not job['ok']:
+            sys.stderr.write("FAILED {target} <- {source} #{slide}\n{error}\n".format(**job))
+    summary = report['summary']
+    print("{jobs} jobs, {failed} failed, {targets} targets in {seconds:.2f}s "
+          "({jobs_per_second:.1f} jobs/s)".format(**summary))
+    sys.exit(1 if summary['failed'] else 0)
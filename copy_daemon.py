@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+"""Serve slide copies from a warm process over a Unix domain socket.
+
+Starting copy_slide.py for every copy pays for the interpreter, the lxml
+import and cold source decks each time. The server keeps all of that
+warm: source decks stay open in a PackageCache between requests and the
+copies run on a pool of worker threads. Copies into the same target are
+merged by a CommitQueue: all the requests that arrive while a target is
+being rewritten are applied by its next rewrite, under the target's lock.
+
+Every connection sends one JSON request per line and gets one JSON
+response line back:
+    {"source": "A.pptx", "slide": 3, "target": "B.pptx", "output": "C.pptx"}
+    {"ok": true, "seconds": 0.012, "batch": 3, "trace": {"steps": ..., "counters": ...}}
+where "batch" is the number of requests applied by the same rewrite.
+"output" is optional (the target is then updated in place), as is
+"dedup"; relative paths are resolved against the server's folder. A
+failed copy answers {"ok": false, "error": "..."} and {"command": "stats"}
+returns the request and rewrite counts and the PackageCache statistics.
+A socket left at the path by a server that is gone is replaced; the
+server refuses to start if the path is not a socket or is still served.
+With --verify, every copy is checked by copy_slide.verify_parts() and one
+that would break its target fails instead.
+"""
+import os, sys, json, stat, time, errno, signal, socket, threading, traceback
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+from copy_slide import CommitQueue, CopyTrace, PackageCache, copy_slides
+
+
+class CopyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server running copy requests on *workers* threads."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=4, cache=None, index_dir=None, verify=False):
+        remove_stale_socket(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, CopyHandler)
+        self.socket_path = socket_path
+        self._socket_inode = os.lstat(socket_path).st_ino
+        self.cache = cache if cache is not None else PackageCache(index_dir=index_dir)
+        self.executor = ThreadPoolExecutor(workers)
+        self.queue = CommitQueue(workers, cache=self.cache, verify=verify)
+        self.verify = verify
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def copy(self, request):
+        """Run one copy *request* and return its response dict."""
+        start = time.time()
+        slides = [(request['source'], int(request['slide']))]
+        if request.get('output'):
+            # A new deck of its own: nothing to merge with.
+            response = self.executor.submit(self._copy_to, request, slides).result()
+        else:
+            # Waits outside the executor, so that any number of requests
+            # can queue up for the next rewrite of their target.
+            response = self.queue.submit(request['target'], slides,
+                                         request.get('dedup', False)).result()
+        with self._lock:
+            self.requests += 1
+        return dict(response, ok=True, seconds=time.time() - start)
+
+    def _copy_to(self, request, slides):
+        trace = CopyTrace()
+        copy_slides(request['target'], slides, request.get('dedup', False),
+                    cache=self.cache, trace=trace, output_path=request['output'], lock=True,
+                    verify=self.verify)
+        return {'batch': 1, 'trace': trace.report()}
+
+    def handle_request_line(self, line):
+        try:
+            request = json.loads(line)
+            if request.get('command') == 'stats':
+                return {'ok': True, 'requests': self.requests, 'rewrites': self.queue.rewrites,
+                        'cache': self.cache.stats()}
+            return self.copy(request)
+        except Exception as error:
+            return {'ok': False, 'error': '{}: {}'.format(type(error).__name__, error),
+                    'traceback': traceback.format_exc()}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.executor.shutdown()
+        self.queue.close()
+        self.cache.clear()
+        # Only our own socket: another server may have taken the path over.
+        try:
+            if os.lstat(self.socket_path).st_ino == self._socket_inode:
+                os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_socket(socket_path):
+    """Remove the socket a server that is gone left at *socket_path*.
+
+    Raise FileExistsError if *socket_path* is something else than a socket
+    and OSError (EADDRINUSE) if a server still accepts connections on it.
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, 'not a socket, not removed', socket_path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except ConnectionRefusedError:
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, 'a server is already listening on the socket', socket_path)
+
+
+class CopyHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.handle_request_line(line.decode('utf-8'))
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def send_requests(socket_path, requests):
+    """Send the request dicts to the server at *socket_path*; return the responses."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        file = client.makefile('rwb')
+        responses = []
+        for request in requests:
+            file.write((json.dumps(request) + '\n').encode('utf-8'))
+            file.flush()
+            responses.append(json.loads(file.readline().decode('utf-8')))
+        file.close()
+        return responses
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve or request slide copies over a Unix socket.")
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help="run the server")
+    serve.add_argument('socket_path')
+    serve.add_argument('--workers', type=int, default=4, help="number of copy threads")
+    serve.add_argument('--index-dir',
+                       help="cache the dependency index of every source deck in this folder")
+    serve.add_argument('--verify', action='store_true',
+                       help="check the parts every copy touched before writing its target")
+    copy = commands.add_parser('copy', help="send a copy request to a running server")
+    copy.add_argument('socket_path')
+    copy.add_argument('target')
+    copy.add_argument('source')
+    copy.add_argument('slide', type=int)
+    copy.add_argument('--output', help="write the result here instead of updating target")
+    copy.add_argument('--dedup', action='store_true',
+                      help="share media/embeddings identical to ones already in the target")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = CopyServer(args.socket_path, args.workers, index_dir=args.index_dir,
+                            verify=args.verify)
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    elif args.command == 'copy':
+        # The server resolves relative paths against its own folder.
+        response, = send_requests(args.socket_path, [{
+            'target': os.path.abspath(args.target),
+            'source': os.path.abspath(args.source),
+            'slide': args.slide,
+            'output': args.output and os.path.abspath(args.output),
+            'dedup': args.dedup,
+        }])
+        print(json.dumps(response, indent=2))
+        sys.exit(0 if response['ok'] else 1)
+    else:
+        parser.print_help()
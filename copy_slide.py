@@ -1,489 +1,2318 @@
 #! /usr/bin/env python
-import os, sys
+import io, os, sys, posixpath, json
+import gc, re, errno, struct, time, zlib, zipfile, hashlib, threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from xml.sax.saxutils import quoteattr
 from lxml import etree
-from copy import deepcopy
-from shutil import copyfile, rmtree
-from opcdiag.controller import OpcController
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
-def copy_pptx_sheet(copy_path, slide_number, target_path):
-    # Step 1. Extract copy_path & target_path
-    opc = OpcController()
-    TEMP_FOLDER_SOURCE = copy_path.replace(".pptx", '')
-    opc.extract_package(copy_path, TEMP_FOLDER_SOURCE)
+_tracing = threading.local()
 
-    TEMP_FOLDER_TARGET = target_path.replace(".pptx", '')
-    opc.extract_package(target_path, TEMP_FOLDER_TARGET)
 
-    # Step 2. Find the next_slide_id of target_path
-    slides_list = [x for x in os.listdir("{}/ppt/slides/".format(TEMP_FOLDER_TARGET))
-                   if '.xml' in x]
-    slides_count = len(slides_list)
-    next_slide_id = slides_count + 1
-    for index in range(len(slides_list)):
-        if not any("slide{}.xml".format(index + 1) in s for s in slides_list):
-            next_slide_id = index + 1
-            break
-
-    # Step 3. Copy the oldslide and it's relationship
-    xml_slide = "{}/ppt/slides/slide{}.xml"
-    xml_slide_rel = "{}/ppt/slides/_rels/slide{}.xml.rels"
-    copyfile(xml_slide.format(TEMP_FOLDER_SOURCE, slide_number),
-             xml_slide.format(TEMP_FOLDER_TARGET, next_slide_id))
-    copyfile(xml_slide_rel.format(TEMP_FOLDER_SOURCE, slide_number),
-             xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id))
-
-
-    replaceString = {}
-    # Step 3-1 Find the oleObject and related data files.
-    # Get the oleObject#.bin file from the slide relation (hacky indeed)
-    with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id)) as file:
-        lines = [line for line in file.readlines() if '/embeddings/oleObject' in line]
-
-    # Paths where the files are
-    bin_oleObject = "{}/ppt/embeddings/oleObject{}.bin"
-
-    # If there are no oleObject in this slide, no need to do the files/data copying
-    if len(lines) > 0:
-        for line in lines:
-            # Step 5. Find the oleObject_id
-            # example: oleObject1.bin, oleObject2.bin, oleObject3.bin
-            oleObject_filename = line.split('Target="../embeddings/')[-1].replace('"/>\n', '')
-            oleObject_id = int(oleObject_filename.replace('oleObject', '').replace('.bin', ''))
-
-            # Step 6. Find the next_oleObject_id
-            try:
-                oleObject_list = [x for x in os.listdir("{}/ppt/embeddings/".format(TEMP_FOLDER_TARGET))
-                               if 'oleObject' in x]
-                next_oleObject_id = len(oleObject_list) + 1
-                for index in range(len(oleObject_list)):
-                    if not any("oleObject{}.bin".format((index + 1)) in s for s in oleObject_list):
-                        next_oleObject_id = index + 1
-                        break
-            except:
-                #no embeddings folder
-                os.mkdir("{}/ppt/embeddings".format(TEMP_FOLDER_TARGET))
-                next_oleObject_id = 1;
-
-
-            copyfile(bin_oleObject.format(TEMP_FOLDER_SOURCE, oleObject_id),
-                     bin_oleObject.format(TEMP_FOLDER_TARGET, next_oleObject_id))
-
-            # Step 10. Replace the Target attribute in the slide#.xml.rel
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'r') as slide_rel:
-                xml_slide_rel_file = slide_rel.read()
-
-            xml_slide_rel_file = xml_slide_rel_file.replace(
-                'oleObject{}.bin'.format(oleObject_id),
-                'oleObject{}.bin'.format(next_oleObject_id)
-            )
-
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'w') as slide_rel:
-                slide_rel.write(xml_slide_rel_file)
-
-
-    # Step 3-2 Find the image and related data files.
-    # Get the image#.xxx file from the slide relation (hacky indeed)
-    with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id)) as file:
-        lines = [line for line in file.readlines() if '/media/image' in line]
-
-    # Paths where the files are
-    xxx_image = "{}/ppt/media/image{}.{}"
-
-    # If there are no image in this slide, no need to do the files/data copying
-    if len(lines) > 0:
-        for line in lines:
-            # Step 5. Find the image_id and ext
-            # example: image1.xxx, image2.xxx, image3.xxx
-            image_filename = line.split('Target="../media/')[-1].replace('"/>\n', '')
-            image_id = int(image_filename.replace('image', '').split(".")[0])
-            image_ext = image_filename.replace('image', '').split(".")[1]
-
-            # Step 6. Find the next_image_id
-            try:
-                image_list = [x for x in os.listdir("{}/ppt/media/".format(TEMP_FOLDER_TARGET))
-                               if '.{}'.format(image_ext) in x]
-                next_image_id = len(image_list) + 1
-                for index in range(len(image_list)):
-                    if not any("image{}.{}".format((index + 1), image_ext) in s for s in image_list):
-                        next_image_id = index + 1
-                        break
-                
-            except:
-                #no media folder
-                os.mkdir("{}/ppt/media".format(TEMP_FOLDER_TARGET))
-                next_image_id = 1;
+class CopyTrace(object):
+    """Wall time per step and counters of the copies run while it is active.
+
+    Use it as a context manager (copy_slides does so for its *trace*
+    argument); it records into ``steps`` the total seconds and the number
+    of runs of every step, and into ``counters`` the bytes read and
+    written, the XML parses and serializations and the parts copied or
+    shared per folder. *callback*, if given, is called as
+    ``callback(step, seconds)`` each time a step finishes.
+    """
 
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.steps = OrderedDict()
+        self.counters = OrderedDict()
+
+    def __enter__(self):
+        if not hasattr(_tracing, 'stack'):
+            _tracing.stack = []
+        _tracing.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _tracing.stack.pop()
 
-            copyfile(xxx_image.format(TEMP_FOLDER_SOURCE, image_id, image_ext),
-                     xxx_image.format(TEMP_FOLDER_TARGET, next_image_id, image_ext))
+    @contextmanager
+    def step(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            totals = self.steps.setdefault(name, {'seconds': 0.0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['count'] += 1
+            if self.callback is not None:
+                self.callback(name, seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def maximum(self, name, value):
+        """Record counter *name* as the largest *value* seen (e.g. peak_rss)."""
+        self.counters[name] = max(self.counters.get(name, 0), value)
+
+    def report(self):
+        return {'steps': self.steps, 'counters': self.counters}
+
+    def write_report(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+
+class _NoTrace(object):
+    """Stand-in for CopyTrace while no trace is active."""
+
+    @contextmanager
+    def step(self, name):
+        yield
+
+    def count(self, name, amount=1):
+        pass
+
+    def maximum(self, name, value):
+        pass
+
+
+_NO_TRACE = _NoTrace()
+
+
+def current_trace():
+    """The CopyTrace active in this thread, or a no-op stand-in."""
+    stack = getattr(_tracing, 'stack', None)
+    return stack[-1] if stack else _NO_TRACE
+
+
+def parse_xml(data, parser=None):
+    current_trace().count('xml_parses')
+    return etree.fromstring(data, parser)
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (see reset_peak_rss())."""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Restart peak_rss() from the current resident set size (Linux only).
+
+    Returns whether it could, so per-job peaks are only reported as such
+    where they are meaningful.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class PeakRSS(object):
+    """Peak resident memory of this process over a ``with`` block.
+
+    ``peak`` is set on leaving the block, in bytes, or left None where
+    peak_rss() cannot be restarted (see reset_peak_rss()) and would only
+    give the peak since the process started. The peak is restarted only
+    when no other block is open, so overlapping blocks (concurrent
+    copies) all get the peak since the first of them started.
+    """
+
+    _lock = threading.Lock()
+    _open = 0
+    _measured = False
+
+    def __init__(self):
+        self.peak = None
+        self.measured = False
+
+    def __enter__(self):
+        with PeakRSS._lock:
+            if not PeakRSS._open:
+                PeakRSS._measured = reset_peak_rss()
+            PeakRSS._open += 1
+            self.measured = PeakRSS._measured
+        return self
+
+    def current(self):
+        """The peak so far in the block, or None where it is not measured."""
+        return peak_rss() if self.measured else None
+
+    def __exit__(self, *exc_info):
+        self.peak = self.current()
+        with PeakRSS._lock:
+            PeakRSS._open -= 1
+
+
+class MemoryBudget(object):
+    """Resident memory budget of a copy, for memory-bounded runs.
+
+    While a budget is given, the XML core parts of the target larger than
+    *large_xml* bytes are scanned and appended to instead of parsed into
+    trees (see LeanPart) and the new parts are compressed one at a time.
+    :meth:`check` runs after every slide: once the resident set exceeds
+    *limit* bytes, the caches are emptied, and if that does not bring it
+    back under the limit MemoryError is raised, so the job fails instead
+    of the process being killed.
+    """
+
+    def __init__(self, limit, large_xml=256 * 1024):
+        self.limit = limit
+        self.large_xml = large_xml
+
+    def check(self, cache=None, packages=()):
+        """Raise MemoryError if over budget even with *cache* and *packages* emptied."""
+        if current_rss() <= self.limit:
+            return
+        if cache is not None:
+            cache.clear()
+        for package in packages:
+            package.clear_cache()
+        gc.collect()
+        rss = current_rss()
+        if rss > self.limit:
+            raise MemoryError('{:.1f} MB resident, over the {:.1f} MB budget'.format(
+                rss / 1048576.0, self.limit / 1048576.0))
+
+
+class Package(object):
+    """An OPC package read straight from its zip central directory.
+
+    Parts are only inflated when they are read. Parts written with
+    :meth:`write` are kept in memory and parts registered with
+    :meth:`copy_part` point at an entry of another package; every other
+    entry is copied raw (still compressed) into the output by :meth:`save`.
+
+    Inflated entries of at most *part_size_limit* bytes are kept, so a
+    package that is read repeatedly (see PackageCache) inflates them once.
+
+    *file* is a path, the bytes of the package or a seekable binary file
+    object; only a package opened from a path has a :attr:`path` and only
+    a file the package opened itself is closed by :meth:`close`. A target
+    package given a MemoryBudget *budget* is written memory-bounded.
+    """
+
+    def __init__(self, file, part_size_limit=0, budget=None):
+        self.path = None
+        self.part_size_limit = part_size_limit
+        self.budget = budget
+        self._lock = threading.RLock()
+        self._owns_file = not hasattr(file, 'read')
+        if isinstance(file, (bytes, bytearray)):
+            self._file = io.BytesIO(file)
+        elif self._owns_file:
+            self.path = file
+            self._file = open(file, 'rb')
+        else:
+            self._file = file
+        self._zip = zipfile.ZipFile(self._file)
+        self._entries = OrderedDict(
+            (info.filename, info) for info in self._zip.infolist()
+        )
+        self._written = OrderedDict()
+        self._copied = OrderedDict()
+        self._allocator = None
+        self._session = None
+        self._duplicates = None
+        self._index = None
+        self._part_cache = {}
+        self._cached_bytes = 0
+        # Called with the package and the size of a part about to be cached;
+        # the part is only cached if it returns true (see PackageCache).
+        self.on_cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+        if self._owns_file:
+            self._file.close()
+
+    def names(self):
+        names = list(self._entries)
+        names.extend(name for name in self._written if name not in self._entries)
+        names.extend(name for name in self._copied
+                     if name not in self._entries and name not in self._written)
+        return names
+
+    def exists(self, name):
+        return name in self._entries or name in self._written or name in self._copied
+
+    def modified_names(self):
+        """Names of the parts written or copied into this package."""
+        return list(self._written) + [name for name in self._copied if name not in self._written]
+
+    def read(self, name):
+        if name in self._written:
+            return self._written[name]
+        if name in self._copied:
+            package, source_name = self._copied[name]
+            return package.read(source_name)
+        data = self._part_cache.get(name)
+        if data is not None:
+            return data
+        with self._lock:
+            data = self._zip.read(name)
+        current_trace().count('bytes_read', self._entries[name].compress_size)
+        if len(data) <= self.part_size_limit and (
+                self.on_cache is None or self.on_cache(self, len(data))):
+            with self._lock:
+                if name not in self._part_cache:
+                    self._part_cache[name] = data
+                    self._cached_bytes += len(data)
+        return data
+
+    def chunks(self, name):
+        """The bytes of part *name*, inflated a chunk at a time as they are read."""
+        if name in self._written or name in self._part_cache:
+            yield self.read(name)
+            return
+        if name in self._copied:
+            package, source_name = self._copied[name]
+            for chunk in package.chunks(source_name):
+                yield chunk
+            return
+        info, raw = self.raw_entry(name)
+        if info.compress_type == zipfile.ZIP_STORED:
+            for chunk in raw:
+                yield chunk
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            for chunk in raw:
+                # Bounded so a highly compressed chunk does not balloon.
+                data = inflater.decompress(chunk, COPY_CHUNK_SIZE)
+                while data:
+                    yield data
+                    data = inflater.decompress(inflater.unconsumed_tail, COPY_CHUNK_SIZE)
+            yield inflater.flush()
+        else:
+            yield self.read(name)
+
+    def size(self, name):
+        """Size in bytes of part *name*."""
+        if name in self._written:
+            return len(self._written[name])
+        if name in self._copied:
+            package, source_name = self._copied[name]
+            return package.size(source_name)
+        return self._entries[name].file_size
+
+    def clear_cache(self):
+        """Drop the inflated parts kept per *part_size_limit*."""
+        with self._lock:
+            self._part_cache = {}
+            self._cached_bytes = 0
+
+    def memory_size(self):
+        """Rough estimate of the memory held: cached parts and the central directory."""
+        with self._lock:
+            written = list(self._written.values())
+            return (self._cached_bytes + sum(len(data) for data in written) +
+                    len(self._entries) * ZIPINFO_SIZE)
+
+    def write(self, name, data):
+        self._copied.pop(name, None)
+        self._written[name] = data
+        if self._allocator is not None:
+            self._allocator.add(name)
+        if self._duplicates is not None:
+            self._duplicates.add(name)
+
+    def copied_from(self, name):
+        """``(package, source name)`` part *name* is copied from, or None."""
+        return self._copied.get(name)
+
+    def copy_part(self, package, source_name, name):
+        """Add part *name* holding the bytes of *source_name* in *package*."""
+        self._written.pop(name, None)
+        self._copied[name] = (package, source_name)
+        if self._allocator is not None:
+            self._allocator.add(name)
+        if self._duplicates is not None:
+            self._duplicates.add(name)
+
+    @property
+    def allocator(self):
+        """PartNameAllocator over the parts of this package, built on first use."""
+        if self._allocator is None:
+            self._allocator = PartNameAllocator(self.names())
+        return self._allocator
+
+    @property
+    def index(self):
+        """SourceIndex of this package, resolved lazily unless one was set."""
+        if self._index is None:
+            self._index = SourceIndex(self)
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
+
+    @property
+    def duplicates(self):
+        """DuplicateIndex over the media and embeddings, built on first use."""
+        if self._duplicates is None:
+            self._duplicates = DuplicateIndex(self)
+        return self._duplicates
+
+    def fingerprint(self, name):
+        """``(size, CRC-32)`` of part *name*, from the central directory if possible."""
+        if name in self._written:
+            data = self._written[name]
+            return len(data), zlib.crc32(data) & 0xffffffff
+        if name in self._copied:
+            package, source_name = self._copied[name]
+            return package.fingerprint(source_name)
+        info = self._entries[name]
+        return info.file_size, info.CRC
+
+    @property
+    def session(self):
+        """TargetSession over the core parts of this package, parsed on first use."""
+        if self._session is None:
+            self._session = TargetSession(
+                self, self.budget.large_xml if self.budget is not None else 0)
+        return self._session
+
+    def raw_entry(self, name):
+        """Return the ZipInfo and the still-compressed bytes of entry *name*.
+
+        The bytes are an iterator of chunks of at most COPY_CHUNK_SIZE
+        bytes, read as they are consumed.
+        """
+        info = self._entries[name]
+        with self._lock:
+            self._file.seek(info.header_offset)
+            header = struct.unpack(zipfile.structFileHeader,
+                                   self._file.read(zipfile.sizeFileHeader))
+            name_length, extra_length = header[-2:]
+            offset = info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+        return info, self._raw_chunks(info, offset)
+
+    def _raw_chunks(self, info, offset):
+        remaining = info.compress_size
+        while remaining > 0:
+            # The file may be shared with other threads, hence the seek.
+            with self._lock:
+                self._file.seek(offset)
+                chunk = self._file.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile('Truncated entry {}'.format(info.filename))
+            current_trace().count('bytes_read', len(chunk))
+            offset += len(chunk)
+            remaining -= len(chunk)
+            yield chunk
+
+    def write_to(self, file, policy=None):
+        """Write the package to *file*, compressing new parts per *policy*."""
+        if policy is None:
+            policy = DEFAULT_POLICY
+        if self._session is not None:
+            self._session.commit()
+        writer = ZipWriter(file)
+        executor = None
+        compressed = {}
+        # Large parts are compressed ahead on a thread pool (zlib releases
+        # the GIL), the rest inline while streaming the entries out. Within
+        # a memory budget, all of them are compressed inline, one at a time.
+        for name, data in self._written.items():
+            if self.budget is None and policy.parallel(name, data):
+                if executor is None:
+                    executor = ThreadPoolExecutor(policy.workers)
+                compressed[name] = executor.submit(policy.compress, name, data)
+        try:
+            self._write_entries(writer, policy, compressed)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _write_entries(self, writer, policy, compressed):
+        for name in self.names():
+            if name in compressed:
+                writer.add_compressed(name, *compressed[name].result())
+            elif name in self._written:
+                writer.add_compressed(name, *policy.compress(name, self._written[name]))
+            elif name in self._copied:
+                package, source_name = self._copied[name]
+                info, data = package.raw_entry(source_name)
+                writer.add_raw(name, info, data)
+            else:
+                info, data = self.raw_entry(name)
+                writer.add_raw(name, info, data)
+        writer.close()
+
+    def save(self, path, policy=None):
+        # The package may still be reading from *path*, so the output goes
+        # to a sibling file that replaces it once complete (and on disk):
+        # readers see either the old or the new deck, never a partial one.
+        temp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(temp_path, 'wb') as file:
+                self.write_to(file, policy)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+# Approximate memory held per central directory entry (ZipInfo and name).
+ZIPINFO_SIZE = 512
+
+# Parts are copied and inflated this many bytes at a time.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class CompressionPolicy(object):
+    """How the parts a package writes itself are compressed.
+
+    Entries copied raw from a zip keep their compression; this only applies
+    to new and modified parts. Parts whose extension is in *stored* hold
+    already-compressed data and are written with ZIP_STORED; every other
+    part is deflated at the zlib level *levels* gives for its extension,
+    or *level*. Parts of at least *parallel_size* bytes are compressed on
+    a pool of *workers* threads.
+    """
+
+    STORED = ('png', 'jpg', 'jpeg', 'gif', 'tif', 'tiff', 'wdp', 'emz', 'wmz',
+              'mp3', 'mp4', 'm4a', 'm4v', 'wma', 'wmv', 'mov', 'avi',
+              'xlsx', 'xlsm', 'docx', 'pptx', 'zip', 'bin')
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, levels=None, stored=STORED,
+                 parallel_size=256 * 1024, workers=4):
+        self.level = level
+        self.levels = dict((extension.lower(), value)
+                           for extension, value in (levels or {}).items())
+        self.stored = frozenset(extension.lower() for extension in stored)
+        self.parallel_size = parallel_size
+        self.workers = workers
+
+    def _extension(self, name):
+        return posixpath.splitext(name)[1][1:].lower()
+
+    def compress_type(self, name):
+        if self._extension(name) in self.stored:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def parallel(self, name, data):
+        return (self.workers > 1 and len(data) >= self.parallel_size and
+                self.compress_type(name) == zipfile.ZIP_DEFLATED)
+
+    def compress(self, name, data):
+        """``(compress_type, CRC-32, size, compressed data)`` of part *name*."""
+        crc = zlib.crc32(data) & 0xffffffff
+        if self.compress_type(name) == zipfile.ZIP_STORED:
+            return zipfile.ZIP_STORED, crc, len(data), data
+        level = self.levels.get(self._extension(name), self.level)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return (zipfile.ZIP_DEFLATED, crc, len(data),
+                compressor.compress(data) + compressor.flush())
+
+
+DEFAULT_POLICY = CompressionPolicy()
+
+
+class ZipWriter(object):
+    """Minimal zip writer that also accepts already-compressed entry data.
+
+    Offsets are tracked locally so *file* only needs a ``write`` method.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._offset = 0
+        self._central_directory = []
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+        current_trace().count('bytes_written', len(data))
+
+    def add(self, name, data, policy=None):
+        self.add_compressed(name, *(policy or DEFAULT_POLICY).compress(name, data))
+
+    def add_compressed(self, name, compress_type, crc, file_size, compressed):
+        self._add_entry(name, compress_type, 0, time.localtime()[:6],
+                        crc, len(compressed), file_size, compressed)
+
+    def add_raw(self, name, info, data):
+        # Bit 3 announces a trailing data descriptor; the sizes are written
+        # in the local header instead, so it is dropped.
+        self._add_entry(name, info.compress_type, info.flag_bits & ~0x08,
+                        info.date_time, info.CRC, info.compress_size,
+                        info.file_size, data)
+
+    def _add_entry(self, name, compress_type, flag_bits, date_time, crc,
+                   compress_size, file_size, data):
+        try:
+            filename = name.encode('ascii')
+        except UnicodeEncodeError:
+            filename = name.encode('utf-8')
+            flag_bits |= 0x800
+        year, month, day, hour, minute, second = date_time
+        dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+        if self._offset > 0xffffffff or compress_size > 0xffffffff:
+            raise zipfile.LargeZipFile('Package exceeds the 4 GiB zip limit')
+        self._central_directory.append((
+            filename, flag_bits, compress_type, dos_time, dos_date, crc,
+            compress_size, file_size, self._offset,
+        ))
+        self._write(struct.pack(
+            zipfile.structFileHeader, zipfile.stringFileHeader, 20, 0,
+            flag_bits, compress_type, dos_time, dos_date, crc,
+            compress_size, file_size, len(filename), 0,
+        ))
+        self._write(filename)
+        if isinstance(data, bytes):
+            self._write(data)
+        else:
+            for chunk in data:
+                self._write(chunk)
+
+    def close(self):
+        start = self._offset
+        for (filename, flag_bits, compress_type, dos_time, dos_date, crc,
+             compress_size, file_size, offset) in self._central_directory:
+            self._write(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir, 20, 0, 20, 0,
+                flag_bits, compress_type, dos_time, dos_date, crc,
+                compress_size, file_size, len(filename), 0, 0, 0, 0, 0, offset,
+            ))
+            self._write(filename)
+        count = len(self._central_directory)
+        self._write(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0,
+            count, count, self._offset - start, start, 0,
+        ))
 
-            # Step 10. Replace the Target attribute in the slide#.xml.rel
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'r') as slide_rel:
-                xml_slide_rel_file = slide_rel.read()
 
-            xml_slide_rel_file = xml_slide_rel_file.replace(
-                'image{}.{}'.format(image_id, image_ext),
-                'image{}.{}'.format(next_image_id, image_ext)
-            )
+class IdAllocator(object):
+    """Hands out the lowest free integer id that is not below *start*."""
+
+    def __init__(self, used=(), start=1):
+        self._used = set(used)
+        self._next = start
+
+    def add(self, id):
+        self._used.add(id)
+
+    def allocate(self):
+        # Ids are never released, so _next only moves forward.
+        while self._next in self._used:
+            self._next += 1
+        self._used.add(self._next)
+        return self._next
 
-            replaceString["/media/image{}.{}".format(image_id, image_ext)] = "/media/image{}.{}".format(next_image_id, image_ext)
 
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'w') as slide_rel:
-                slide_rel.write(xml_slide_rel_file)
+PART_NUMBER = re.compile(r'^(.*?)(\d+)((?:\.[^./]+)*)$')
 
 
+class PartNameAllocator(object):
+    """Free part numbers per name prefix, e.g. ``ppt/media/image`` -> 5.
 
-    # Step 3-3 Find the drawingfile and related data files.
-    # Get the vmlDrawing#.vml file from the slide relation (hacky indeed)
-    with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id)) as file:
-        lines = [line for line in file.readlines() if '/drawings/vmlDrawing' in line]
+    Built once from a package's part list; numbers are shared across
+    extensions so ``image5.png`` and ``image5.jpeg`` are never both handed
+    out.
+    """
 
-    # Paths where the files are
-    vml_Drawing = "{}/ppt/drawings/vmlDrawing{}.vml"
-    vml_Drawing_rel = "{}/ppt/drawings/_rels/vmlDrawing{}.vml.rels"
+    def __init__(self, names=()):
+        self._numbers = {}
+        for name in names:
+            self.add(name)
 
-    # If there are no vmlDrawing in this slide, no need to do the files/data copying
-    if len(lines) > 0:
-        for line in lines:
-            # Step 5. Find the vmlDrawing_id
-            # example: vmlDrawing1.vml, vmlDrawing2.vml, vmlDrawing3.vml
-            vmlDrawing_filename = line.split('Target="../drawings/')[-1].replace('"/>\n', '')
-            vmlDrawing_id = int(vmlDrawing_filename.replace('vmlDrawing', '').replace('.vml', ''))
+    def _allocator(self, prefix):
+        if prefix not in self._numbers:
+            self._numbers[prefix] = IdAllocator()
+        return self._numbers[prefix]
 
-            # Step 6. Find the next_vmlDrawing_id
-            try:
-                vmlDrawing_list = [x for x in os.listdir("{}/ppt/drawings/".format(TEMP_FOLDER_TARGET))
-                               if 'vmlDrawing' in x]
-                vmlDrawing_count = len(vmlDrawing_list)
-                next_vmlDrawing_id = vmlDrawing_count + 1
-                for index in range(len(vmlDrawing_list)):
-                    if not any("vmlDrawing{}.vml".format(index + 1) in vmlDrawing for vmlDrawing in vmlDrawing_list):
-                        next_vmlDrawing_id = index + 1
-                        break
-            except:
-                #no drawings folder
-                os.mkdir("{}/ppt/drawings".format(TEMP_FOLDER_TARGET))
-                os.mkdir("{}/ppt/drawings/_rels".format(TEMP_FOLDER_TARGET))
-                next_vmlDrawing_id = 1;
-
-
-            copyfile(vml_Drawing.format(TEMP_FOLDER_SOURCE, vmlDrawing_id),
-                     vml_Drawing.format(TEMP_FOLDER_TARGET, next_vmlDrawing_id))
-            copyfile(vml_Drawing_rel.format(TEMP_FOLDER_SOURCE, vmlDrawing_id),
-                     vml_Drawing_rel.format(TEMP_FOLDER_TARGET, next_vmlDrawing_id))
-
-            #check if vml_Drawing_rel file contains replace string
-            with open(vml_Drawing_rel.format(TEMP_FOLDER_TARGET, next_vmlDrawing_id), 'r') as drawing_rel:
-                xml_drawing_rel_file = drawing_rel.read()
-
-            for key in replaceString.keys():
-            	xml_drawing_rel_file = xml_drawing_rel_file.replace(key, replaceString[key])
-
-            with open(vml_Drawing_rel.format(TEMP_FOLDER_TARGET, next_vmlDrawing_id), 'w') as drawing_rel:
-                drawing_rel.write(xml_drawing_rel_file)
-
-            # Step 10. Replace the Target attribute in the slide#.xml.rel
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'r') as slide_rel:
-                xml_slide_rel_file = slide_rel.read()
-
-            xml_slide_rel_file = xml_slide_rel_file.replace(
-                'vmlDrawing{}.vml'.format(vmlDrawing_id),
-                'vmlDrawing{}.vml'.format(next_vmlDrawing_id)
-            )
-
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'w') as slide_rel:
-                slide_rel.write(xml_slide_rel_file)
-
-    # Step 4 Find the chartfile and related data files.
-    # Get the chart#.xml file from the slide relation (hacky indeed)
-    with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id)) as file:
-        lines = [line for line in file.readlines() if '/charts/chart' in line]
-
-    # Paths where the files are
-    xml_chart = "{}/ppt/charts/chart{}.xml"
-    xml_style = "{}/ppt/charts/style{}.xml"
-    xml_colors = "{}/ppt/charts/colors{}.xml"
-    xml_chart_rel = "{}/ppt/charts/_rels/chart{}.xml.rels"
-    xml_xlsx = "{}/ppt/embeddings/Microsoft_Excel_Worksheet{}.xlsx"
-
-    # This gets populated with lxml Elements, they will go into [Content_Types].xml
-    content_types = [
-        etree.XML('<Override PartName="/ppt/slides/slide{}.xml" ContentType="application/vnd.openxmlformats-officedocument.presentationml.slide+xml"/>'.format(
-            next_slide_id
-        ))
-    ]
-
-    # If there are no charts in this slide, no need to do the files/data copying
-    if len(lines) > 0:
-        for line in lines:
-            # Reset the filenames. The files are not always in the pptx file.
-            style_filename = None
-            colors_filename = None
-            xlsx_filename = None
-
-            # Step 5. Find the chart_id
-            # example: chart1.xml, chart2.xml, chart3.xml
-            chart_filename = line.split('Target="../charts/')[-1].replace('"/>\n', '')
-            chart_id = int(chart_filename.replace('chart', '').replace('.xml', ''))
-
-            # Step 6. Find the next_chart_id
-            try:
-                chart_list = [x for x in os.listdir("{}/ppt/charts/".format(TEMP_FOLDER_TARGET))
-                               if 'chart' in x]
-                next_chart_id = len(chart_list) + 1
-                for index in range(len(chart_list)):
-                    if not any("chart{}.xml".format((index + 1)) in s for s in chart_list):
-                        next_chart_id = index + 1
-                        break
-            except:
-                #no charts folder
-                os.mkdir("{}/ppt/charts".format(TEMP_FOLDER_TARGET))
-                next_chart_id = 1;
-            
-
-            # Step 7. Get the style#.xml, colors#.xml and #.xlsx filenames and ids
-            with open(xml_chart_rel.format(TEMP_FOLDER_SOURCE, chart_id)) as file:
-                for line in file.readlines():
-                    if 'Target="style' in line:
-                        style_filename = line.split('Target="')[-1].replace('"/>\n', '')
-                        style_id = style_filename.replace('style', '').replace('.xml', '')
-                    if 'Target="colors' in line:
-                        colors_filename = line.split('Target="')[-1].replace('"/>\n', '')
-                        colors_id = colors_filename.replace('colors', '').replace('.xml', '')
-                    elif 'Target="../embeddings' in line:
-                        xlsx_filename = line.split('Target="../embeddings/')[-1].replace('"/>\n', '')
-                        xlsx_id = xlsx_filename.replace('Microsoft_Excel_Worksheet', '').replace('.xlsx', '')
-
-            # Step 8. Copy the charts, styles, colors, xlsx and rel files.
-            # Note: The "-1" id's are used later to skip checking if the id
-            # exists. The replace method won't find the -1 ids, so it skips them.
-            if style_filename is not None:
-                style_list = [x for x in os.listdir("{}/ppt/charts/".format(TEMP_FOLDER_TARGET))
-                               if 'style' in x]
-                next_style_id = len(style_list) + 1
-                for index in range(len(style_list)):
-                    if not any("style{}.xml".format((index + 1)) in s for s in style_list):
-                        next_style_id = index + 1
-                        break
-                copyfile(xml_style.format(TEMP_FOLDER_SOURCE, style_id),
-                         xml_style.format(TEMP_FOLDER_TARGET, next_style_id))
-                content_types.append(
-                    etree.XML(
-                          '<Override PartName="/ppt/charts/style{}.xml" ContentType="application/vnd.ms-office.chartstyle+xml"/>'.format(
-                            next_style_id
-                        )
-                    )
+    def add(self, name):
+        match = PART_NUMBER.match(name)
+        if match:
+            self._allocator(match.group(1)).add(int(match.group(2)))
+
+    def next_id(self, prefix):
+        return self._allocator(prefix).allocate()
+
+    def next_name(self, name):
+        """A free part name in the series of *name*: image3.png -> image8.png."""
+        match = PART_NUMBER.match(name)
+        if match:
+            prefix, suffix = match.group(1), match.group(3)
+        else:
+            prefix, suffix = posixpath.splitext(name)
+        return '{}{}{}'.format(prefix, self.next_id(prefix), suffix)
+
+
+# Parts in these folders are shared instead of copied when deduplicating.
+DEDUP_FOLDERS = ('ppt/media/', 'ppt/embeddings/')
+
+
+class DuplicateIndex(object):
+    """Content index of the media and embedding parts of a package.
+
+    Parts are keyed by the size and CRC-32 already stored in the zip central
+    directory, so building the index inflates nothing. A candidate with the
+    same key and extension is only reused once its SHA-1 digest matches.
+    """
+
+    def __init__(self, package):
+        self._package = package
+        self._parts = {}
+        self._digests = {}
+        for name in package.names():
+            self.add(name)
+
+    def add(self, name):
+        if name.startswith(DEDUP_FOLDERS):
+            self._parts.setdefault(self._package.fingerprint(name), []).append(name)
+            self._digests.pop(name, None)
+
+    def _digest(self, package, name):
+        digest = hashlib.sha1()
+        for chunk in package.chunks(name):
+            digest.update(chunk)
+        return digest.digest()
+
+    def find(self, package, name):
+        """Name of a part identical to part *name* of *package*, or None."""
+        candidates = self._parts.get(package.fingerprint(name))
+        if not candidates:
+            return None
+        extension = posixpath.splitext(name)[1].lower()
+        digest = None
+        for candidate in candidates:
+            if posixpath.splitext(candidate)[1].lower() != extension:
+                continue
+            if digest is None:
+                digest = self._digest(package, name)
+            if candidate not in self._digests:
+                self._digests[candidate] = self._digest(self._package, candidate)
+            if self._digests[candidate] == digest:
+                return candidate
+        return None
+
+
+def serialize(root):
+    current_trace().count('xml_serializations')
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+
+CONTENT_TYPES_NS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+
+# Parses XML for fingerprinting: the indentation of a part does not count.
+NORMALIZING_PARSER = etree.XMLParser(remove_blank_text=True)
+
+# Parts in these folders belong to the slide that relates to them, so they
+# are copied (and renumbered) along with it. Everything else a slide relates
+# to - its slideLayout, notesSlide, other slides - is left pointing into
+# the target deck.
+COPIED_FOLDERS = ('ppt/embeddings/', 'ppt/media/', 'ppt/drawings/', 'ppt/charts/',
+                  'ppt/notesSlides/', 'ppt/diagrams/', 'ppt/tags/', 'ppt/comments/')
+
+
+def rels_name(part_name):
+    """Name of the .rels part holding the relationships of *part_name*."""
+    folder, filename = posixpath.split(part_name)
+    return posixpath.join(folder, '_rels', filename + '.rels')
+
+
+def resolve_target(part_name, target):
+    """Part name that the relationship Target *target* of *part_name* points at."""
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(part_name), target))
+
+
+def relative_target(part_name, target_name):
+    """Relationship Target from *part_name* to the part *target_name*."""
+    return posixpath.relpath(target_name, posixpath.dirname(part_name))
+
+
+class Relationships(object):
+    """A ``.rels`` part parsed once, remapped in memory and serialized once."""
+
+    def __init__(self, data):
+        self.root = parse_xml(data)
+
+    def __iter__(self):
+        """The internal relationships, i.e. the ones pointing at a part."""
+        return (rel for rel in self.root if rel.get('TargetMode') != 'External')
+
+    def remap(self, targets):
+        """Replace every Target found in the dict *targets* in a single pass."""
+        for rel in self:
+            target = rel.get('Target')
+            if target in targets:
+                rel.set('Target', targets[target])
+
+    def serialize(self):
+        return serialize(self.root)
+
+
+PRESENTATION_NS = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+SLIDE_RELATIONSHIP = RELATIONSHIPS_NS + '/slide'
+SLIDE_LAYOUT_RELATIONSHIP = RELATIONSHIPS_NS + '/slideLayout'
+SLIDE_MASTER_RELATIONSHIP = RELATIONSHIPS_NS + '/slideMaster'
+NOTES_MASTER_RELATIONSHIP = RELATIONSHIPS_NS + '/notesMaster'
+
+LAYOUTS_FOLDER = 'ppt/slideLayouts/'
+MASTERS_FOLDER = 'ppt/slideMasters/'
+THEMES_FOLDER = 'ppt/theme/'
+NOTES_SLIDES_FOLDER = 'ppt/notesSlides/'
+NOTES_MASTERS_FOLDER = 'ppt/notesMasters/'
+
+# Children of <p:presentation> that come before <p:sldIdLst>, in schema order.
+BEFORE_SLDIDLST = ('sldMasterIdLst', 'notesMasterIdLst', 'handoutMasterIdLst')
+
+# Smallest sldId allowed by the schema.
+MIN_SLIDE_ID = 256
+
+# Smallest sldMasterId/sldLayoutId allowed by the schema; both share one range.
+MIN_LAYOUT_ID = 2147483648
+
+# ElementPaths, from the root, of the elements the copies add to the core parts.
+OVERRIDE_PATH = '{%s}Override' % CONTENT_TYPES_NS
+DEFAULT_PATH = '{%s}Default' % CONTENT_TYPES_NS
+RELATIONSHIP_PATH = '{%s}Relationship' % PACKAGE_RELATIONSHIPS_NS
+SLIDE_ID_PATH = '{0}sldIdLst/{0}sldId'.format('{%s}' % PRESENTATION_NS)
+MASTER_ID_PATH = '{0}sldMasterIdLst/{0}sldMasterId'.format('{%s}' % PRESENTATION_NS)
+LAYOUT_ID_PATH = '{0}sldLayoutIdLst/{0}sldLayoutId'.format('{%s}' % PRESENTATION_NS)
+ANY_SLIDE_ID_PATH = './/{%s}sldId' % PRESENTATION_NS
+
+
+# The parts a memory-bounded TargetSession may scan instead of parse, with
+# the paths of the elements whose attributes it needs.
+LEAN_PARTS = {
+    '[Content_Types].xml': (OVERRIDE_PATH, DEFAULT_PATH),
+    'ppt/_rels/presentation.xml.rels': (RELATIONSHIP_PATH,),
+    'ppt/presentation.xml': (SLIDE_ID_PATH, MASTER_ID_PATH),
+}
+
+# A comment, CDATA section, processing instruction or declaration, or a
+# start (1: '', 2: name, 3: attributes, 4: '' or '/'), empty or end
+# (1: '/', 2: name) tag of an XML document.
+XML_TOKEN = re.compile(
+    br'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[?!][^>]*>|'
+    br'<(/?)([^\s/>]+)((?:\s+[^\s=]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>', re.S)
+XML_NAMESPACE = re.compile(br'\sxmlns(?::([^\s=]+))?\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+def _clark(name, namespaces):
+    prefix, _, local = name.rpartition(b':')
+    uri = namespaces.get(prefix, b'')
+    return '{{{}}}{}'.format(uri.decode('utf-8'), local.decode('utf-8')) if uri else local.decode('utf-8')
+
+
+def element_end(data, tag):
+    """Where the root or a child of the root named *tag* ends in XML *data*.
+
+    *tag* is a ``{namespace}name``; prefixes are resolved by the namespace
+    declarations in scope, so a namesake deeper in the document or in
+    another namespace is never taken for it. Returns the match of its
+    closing tag, or of the whole element if it is empty (group 4 is then
+    '/'); None if there is no such element.
+    """
+    stack = []
+    for match in XML_TOKEN.finditer(data):
+        closing, name, attributes, empty = match.groups()
+        if name is None:
+            continue
+        if closing:
+            name, namespaces = stack.pop()
+            if len(stack) <= 1 and _clark(name, namespaces) == tag:
+                return match
+            continue
+        namespaces = stack[-1][1] if stack else {}
+        declarations = XML_NAMESPACE.findall(attributes)
+        if declarations:
+            namespaces = dict(namespaces)
+            for prefix, double_quoted, single_quoted in declarations:
+                namespaces[prefix] = double_quoted or single_quoted
+        if not empty:
+            stack.append((name, namespaces))
+        elif len(stack) <= 1 and _clark(name, namespaces) == tag:
+            return match
+    return None
+
+
+class LeanPart(object):
+    """A large XML part that is appended to without ever holding its tree.
+
+    The part is scanned once, a chunk at a time, with a pull parser that
+    keeps the attributes of the elements at *paths* (``a/b`` from the
+    root, or ``.//b`` anywhere), the tags of the root and its children and
+    the namespace prefixes of the root, and drops every element once it is
+    complete. Appended elements are spliced in as text, before the closing
+    tag of their parent (the root or one of its children), by :meth:`data`.
+    """
+
+    def __init__(self, package, name, paths):
+        self._package = package
+        self.name = name
+        self.elements = dict((path, []) for path in paths)
+        self._paths = {}
+        for path in paths:
+            tag = re.findall(r'(?:\{[^}]*\})?[^/{]+', path)[-1]
+            self._paths.setdefault(tag, []).append(path)
+        self.tags = set()
+        self.prefixes = None
+        self.appended = OrderedDict()
+        parser = etree.XMLPullParser(events=('end',))
+        for chunk in package.chunks(name):
+            parser.feed(chunk)
+            self._read_events(parser)
+        parser.close()
+        self._read_events(parser)
+        current_trace().count('xml_scans')
+
+    def _read_events(self, parser):
+        for event, value in parser.read_events():
+            ancestors = list(value.iterancestors())
+            if self.prefixes is None:
+                # Only the root's declarations are in scope wherever elements are appended
+                root = ancestors[-1] if ancestors else value
+                self.prefixes = dict((uri, prefix or '') for prefix, uri in root.nsmap.items())
+            if len(ancestors) <= 1:
+                self.tags.add(value.tag)
+            for path in self._paths.get(value.tag, ()):
+                if path.startswith('.//') or path == '/'.join(
+                        [ancestor.tag for ancestor in reversed(ancestors[:-1])] + [value.tag]):
+                    self.elements[path].append(dict(value.attrib))
+            value.clear()
+            while value.getprevious() is not None:
+                del value.getparent()[0]
+
+    def append(self, parent, tag, attrib):
+        self.appended.setdefault(parent, []).append((tag, attrib))
+
+    def _format(self, tag, attrib):
+        """An empty *tag* element using the namespace prefixes of the part."""
+        declarations = OrderedDict()
+
+        def qualify(name, attribute=False):
+            qname = etree.QName(name)
+            if qname.namespace is None:
+                return qname.localname
+            prefix = self.prefixes.get(qname.namespace)
+            if prefix is None or (attribute and not prefix):
+                prefix = 'ns{}'.format(len(declarations))
+                declarations[prefix] = qname.namespace
+            return '{}:{}'.format(prefix, qname.localname) if prefix else qname.localname
+
+        attributes = ''.join(' {}={}'.format(qualify(key, True), quoteattr(value))
+                             for key, value in attrib.items())
+        element = qualify(tag)
+        return '<{}{}{}/>'.format(element, ''.join(
+            ' xmlns:{}={}'.format(prefix, quoteattr(uri)) for prefix, uri in declarations.items()
+        ), attributes)
+
+    def data(self):
+        """The bytes of the part with the appended elements."""
+        data = self._package.read(self.name)
+        for parent, elements in self.appended.items():
+            text = ''.join(self._format(tag, attrib) for tag, attrib in elements).encode('utf-8')
+            end = element_end(data, parent)
+            if not end.group(4):
+                data = data[:end.start()] + text + data[end.start():]
+            else:
+                data = (data[:end.start()] + b'<' + end.group(2) + end.group(3) + b'>' + text +
+                        b'</' + end.group(2) + b'>' + data[end.end():])
+        return data
+
+
+class TargetSession(object):
+    """The core parts of a target deck, parsed once and written once.
+
+    ``[Content_Types].xml``, ``ppt/presentation.xml``, the .rels and the
+    slide masters are each parsed the first time they are needed; every
+    Override, Default, Relationship, sldId and layout added by the copies
+    is applied to those trees in memory, with the PartNames, extensions
+    and ids in use kept in sets. :meth:`commit` serializes the modified
+    parts back into the package (Package.write_to() calls it).
+
+    With *large_xml*, the LEAN_PARTS bigger than that many bytes are not
+    parsed but handled as LeanPart.
+    """
+
+    def __init__(self, package, large_xml=0):
+        self._package = package
+        self.large_xml = large_xml
+        self._roots = {}
+        self._lean = {}
+        self._modified = set()
+        self._part_names = None
+        self._rids = {}
+        self._slide_ids = None
+        self._layout_ids = None
+        self._layouts = None
+        self._masters = None
+        self._notes_master = False
+
+    def root(self, name):
+        """Parsed part *name*; call :meth:`changed` once it is modified."""
+        if name not in self._roots:
+            self._roots[name] = parse_xml(self._package.read(name))
+        return self._roots[name]
+
+    def changed(self, name):
+        self._modified.add(name)
+
+    def _lean_part(self, name):
+        """LeanPart of *name* if it is handled as one, else None."""
+        if name not in self._lean:
+            self._lean[name] = None
+            if (self.large_xml and name in LEAN_PARTS and name not in self._roots and
+                    self._package.size(name) > self.large_xml):
+                self._lean[name] = LeanPart(self._package, name, LEAN_PARTS[name])
+        return self._lean[name]
+
+    def _elements(self, name, path):
+        """The attributes of the elements at *path* (from the root) of part *name*."""
+        lean = self._lean_part(name)
+        if lean is not None:
+            return lean.elements[path]
+        return [element.attrib for element in self.root(name).iterfind(path)]
+
+    def _append(self, name, parent, tag, attrib, before=()):
+        """Append a *tag* element to the *parent* element of part *name*.
+
+        A missing *parent* is created as a child of the root, after the
+        *before* elements (schema order).
+        """
+        lean = self._lean_part(name)
+        if lean is not None and parent in lean.tags:
+            lean.append(parent, tag, attrib)
+        else:
+            if lean is not None:
+                # The parent has to be created, which takes the tree.
+                self._lean[name] = None
+                for appended_parent, elements in lean.appended.items():
+                    for appended in elements:
+                        self._append(name, appended_parent, *appended)
+            root = self.root(name)
+            if root.tag != parent:
+                root = self._child(root, parent, before)
+            etree.SubElement(root, tag, attrib)
+        self.changed(name)
+
+    def _child(self, root, tag, before=()):
+        """The *tag* child of *root*, created in schema order if missing."""
+        element = root.find(tag)
+        if element is None:
+            element = etree.Element(tag)
+            index = 0
+            for position, child in enumerate(root):
+                if etree.QName(child).localname in before:
+                    index = position + 1
+            root.insert(index, element)
+        return element
+
+    def _content_types(self):
+        if self._part_names is None:
+            self._part_names = set(
+                attrib['PartName'] for attrib in
+                self._elements('[Content_Types].xml', OVERRIDE_PATH))
+            self._defaults = dict(
+                (attrib['Extension'].lower(), attrib['ContentType']) for attrib in
+                self._elements('[Content_Types].xml', DEFAULT_PATH))
+
+    def add_override(self, part_name, content_type):
+        """Add an Override for *part_name*, unless it already has one."""
+        self._content_types()
+        if '/' + part_name in self._part_names:
+            return
+        self._append('[Content_Types].xml', '{%s}Types' % CONTENT_TYPES_NS,
+                     '{%s}Override' % CONTENT_TYPES_NS,
+                     OrderedDict([('PartName', '/' + part_name), ('ContentType', content_type)]))
+        self._part_names.add('/' + part_name)
+
+    def add_default(self, extension, content_type):
+        """Add a Default for *extension*, unless it already has one."""
+        self._content_types()
+        if extension.lower() in self._defaults:
+            return
+        self._append('[Content_Types].xml', '{%s}Types' % CONTENT_TYPES_NS,
+                     '{%s}Default' % CONTENT_TYPES_NS,
+                     OrderedDict([('Extension', extension), ('ContentType', content_type)]))
+        self._defaults[extension.lower()] = content_type
+
+    def default_content_type(self, part_name):
+        """The content type the Default for the extension of *part_name* gives it."""
+        self._content_types()
+        return self._defaults.get(posixpath.basename(part_name).rpartition('.')[2].lower())
+
+    def add_relationship(self, part_name, type, target_name):
+        """Relate *part_name* to the part *target_name*; return the new ``rIdN``.
+
+        The relation ids are allocated from every Id in use, so they never
+        clash with existing relations (e.g. the tags/presProps/viewProps/
+        theme/tableStyles of the presentation), which are left untouched.
+        """
+        name = rels_name(part_name)
+        tag = '{%s}Relationship' % PACKAGE_RELATIONSHIPS_NS
+        if name not in self._rids:
+            self._rids[name] = IdAllocator(int(attrib['Id'][3:]) for attrib in
+                                           self._elements(name, RELATIONSHIP_PATH)
+                                           if re.match(r'rId\d+$', attrib.get('Id', '')))
+        rid = 'rId{}'.format(self._rids[name].allocate())
+        self._append(name, '{%s}Relationships' % PACKAGE_RELATIONSHIPS_NS, tag, OrderedDict([
+            ('Id', rid),
+            ('Type', type),
+            ('Target', relative_target(part_name, target_name)),
+        ]))
+        return rid
+
+    def add_slide(self, rid):
+        """Append a sldId for the slide related as *rid*; return its id."""
+        if self._slide_ids is None:
+            # A deck without slides may have no sldIdLst at all.
+            ids = [int(attrib['id']) for attrib in
+                   self._elements('ppt/presentation.xml', SLIDE_ID_PATH)]
+            self._slide_ids = IdAllocator(ids, max(ids + [MIN_SLIDE_ID - 1]) + 1)
+        id = self._slide_ids.allocate()
+        self._append('ppt/presentation.xml', '{%s}sldIdLst' % PRESENTATION_NS,
+                     '{%s}sldId' % PRESENTATION_NS,
+                     OrderedDict([('id', str(id)), ('{%s}id' % RELATIONSHIPS_NS, rid)]),
+                     BEFORE_SLDIDLST)
+        return id
+
+    def _allocate_layout_id(self):
+        return self._layout_id_allocator().allocate()
+
+    def _layout_id_allocator(self):
+        if self._layout_ids is None:
+            ids = [int(attrib['id']) for attrib in
+                   self._elements('ppt/presentation.xml', MASTER_ID_PATH)]
+            for name in self._package.names():
+                if name.startswith(MASTERS_FOLDER) and name.endswith('.xml'):
+                    ids.extend(int(attrib['id']) for attrib in
+                               self._elements(name, LAYOUT_ID_PATH))
+            self._layout_ids = IdAllocator(ids, MIN_LAYOUT_ID)
+        return self._layout_ids
+
+    @property
+    def layouts(self):
+        """``{fingerprint: part name}`` of the slide layouts of the target."""
+        if self._layouts is None:
+            self._find_templates()
+        return self._layouts
+
+    @property
+    def masters(self):
+        """``{fingerprint: part name}`` of the slide masters of the target."""
+        if self._masters is None:
+            self._find_templates()
+        return self._masters
+
+    def _find_templates(self):
+        index = self._package.index
+        self._layouts = {}
+        self._masters = {}
+        for name in self._package.names():
+            if name.endswith('.xml') and name.startswith(LAYOUTS_FOLDER):
+                self._layouts.setdefault(index.fingerprint(name), name)
+            elif name.endswith('.xml') and name.startswith(MASTERS_FOLDER):
+                self._masters.setdefault(index.fingerprint(name), name)
+
+    def add_layout(self, master_name, layout_name, fingerprint):
+        """Add the copied *layout_name* to the layouts of slide master *master_name*."""
+        id = self._allocate_layout_id()
+        rid = self.add_relationship(master_name, SLIDE_LAYOUT_RELATIONSHIP, layout_name)
+        self._append(master_name, '{%s}sldLayoutIdLst' % PRESENTATION_NS,
+                     '{%s}sldLayoutId' % PRESENTATION_NS,
+                     OrderedDict([('id', str(id)), ('{%s}id' % RELATIONSHIPS_NS, rid)]),
+                     ('cSld', 'clrMap'))
+        self.layouts.setdefault(fingerprint, layout_name)
+
+    def add_master(self, master_name, fingerprint):
+        """Add the copied *master_name*, without any layout, to the presentation.
+
+        The layouts the master was copied with are dropped from it; the
+        ones needed are added back with :meth:`add_layout`.
+        """
+        id = self._allocate_layout_id()  # collects the ids in use before dropping any
+        root = self.root(master_name)
+        for sldLayoutIdLst in root.findall('{%s}sldLayoutIdLst' % PRESENTATION_NS):
+            root.remove(sldLayoutIdLst)
+        self.changed(master_name)
+        rels = self.root(rels_name(master_name))
+        for rel in list(rels):
+            if rel.get('Type') == SLIDE_LAYOUT_RELATIONSHIP:
+                rels.remove(rel)
+        self.changed(rels_name(master_name))
+
+        rid = self.add_relationship('ppt/presentation.xml', SLIDE_MASTER_RELATIONSHIP, master_name)
+        self._append('ppt/presentation.xml', '{%s}sldMasterIdLst' % PRESENTATION_NS,
+                     '{%s}sldMasterId' % PRESENTATION_NS,
+                     OrderedDict([('id', str(id)), ('{%s}id' % RELATIONSHIPS_NS, rid)]))
+        self.masters.setdefault(fingerprint, master_name)
+
+    @property
+    def notes_master(self):
+        """Part name of the notes master of the target, or None."""
+        if self._notes_master is False:
+            self._notes_master = None
+            for attrib in self._elements('ppt/_rels/presentation.xml.rels', RELATIONSHIP_PATH):
+                if (attrib.get('Type') == NOTES_MASTER_RELATIONSHIP and
+                        attrib.get('TargetMode') != 'External'):
+                    self._notes_master = resolve_target('ppt/presentation.xml', attrib['Target'])
+        return self._notes_master
+
+    def add_notes_master(self, notes_master_name):
+        """Make the copied *notes_master_name* the notes master of the presentation."""
+        rid = self.add_relationship('ppt/presentation.xml', NOTES_MASTER_RELATIONSHIP,
+                                    notes_master_name)
+        self._append('ppt/presentation.xml', '{%s}notesMasterIdLst' % PRESENTATION_NS,
+                     '{%s}notesMasterId' % PRESENTATION_NS,
+                     OrderedDict([('{%s}id' % RELATIONSHIPS_NS, rid)]), ('sldMasterIdLst',))
+        self._notes_master = notes_master_name
+
+    def commit(self):
+        """Write every modified part back into the package."""
+        for name in sorted(self._modified):
+            lean = self._lean.get(name)
+            if lean is not None:
+                self._package.write(name, lean.data())
+                lean.appended.clear()
+            else:
+                self._package.write(name, serialize(self._roots[name]))
+        self._modified.clear()
+
+
+INDEX_VERSION = 3
+
+
+class SourceIndex(object):
+    """Dependency graph of a source deck: what copying each slide needs.
+
+    For every part it records the relations :func:`copy_part` follows
+    (``{Target: part name}``, or None when the part has no .rels), for
+    every slide the transitive closure of parts copied with it, the
+    fingerprints of the slide layouts and masters, plus the deck's
+    content types. Relations are resolved lazily from the package;
+    :meth:`build` resolves all slides so the index can be saved and reused
+    by :func:`open_source` for as long as the deck is unchanged.
+    """
+
+    def __init__(self, package, data=None):
+        self._package = package
+        if data is None:
+            root = parse_xml(package.read('[Content_Types].xml'))
+            data = {
+                'version': INDEX_VERSION,
+                'defaults': OrderedDict((el.attrib['Extension'], el.attrib['ContentType'])
+                                        for el in root.findall("*[@Extension]")),
+                'overrides': dict((el.attrib['PartName'][1:], el.attrib['ContentType'])
+                                  for el in root.findall("*[@PartName]")),
+                'links': {},
+                'relations': {},
+                'slides': {},
+                'fingerprints': {},
+            }
+        self._data = data
+
+    @property
+    def defaults(self):
+        """``{Extension: ContentType}`` of the Default content types."""
+        return self._data['defaults']
+
+    @property
+    def overrides(self):
+        """``{part name: ContentType}`` of the Override content types."""
+        return self._data['overrides']
+
+    def content_type(self, part_name):
+        if part_name in self.overrides:
+            return self.overrides[part_name]
+        extension = posixpath.splitext(part_name)[1][1:].lower()
+        for key, content_type in self.defaults.items():
+            if key.lower() == extension:
+                return content_type
+        return None
+
+    def links(self, part_name):
+        """``{Target: part name}`` of every internal relation of *part_name*."""
+        links = self._data['links']
+        if part_name not in links:
+            if not self._package.exists(rels_name(part_name)):
+                links[part_name] = None
+            else:
+                links[part_name] = OrderedDict(
+                    (rel.get('Target'), resolve_target(part_name, rel.get('Target')))
+                    for rel in Relationships(self._package.read(rels_name(part_name)))
                 )
+        return links[part_name]
+
+    def relations(self, part_name):
+        """``{Target: part name}`` of the relations of *part_name* to follow."""
+        relations = self._data['relations']
+        if part_name not in relations:
+            links = self.links(part_name)
+            if links is None:
+                relations[part_name] = None
             else:
-                style_id = "-1"
-                next_style_id = "-1"
-
-            if colors_filename is not None:
-                colors_list = [x for x in os.listdir("{}/ppt/charts/".format(TEMP_FOLDER_TARGET))
-                               if 'colors' in x]
-                next_colors_id = len(colors_list) + 1
-                for index in range(len(colors_list)):
-                    if not any("colors{}.xml".format((index + 1)) in s for s in colors_list):
-                        next_colors_id = index + 1
-                        break
-                copyfile(xml_colors.format(TEMP_FOLDER_SOURCE, colors_id),
-                         xml_colors.format(TEMP_FOLDER_TARGET, next_colors_id))
-                content_types.append(
-                    etree.XML(
-                          '<Override PartName="/ppt/charts/colors{}.xml" ContentType="application/vnd.ms-office.chartcolorstyle+xml"/>'.format(
-                            next_colors_id
-                        )
-                    )
+                relations[part_name] = OrderedDict(
+                    (target, name) for target, name in links.items()
+                    if name.startswith(COPIED_FOLDERS) and self._package.exists(name)
                 )
+        return relations[part_name]
+
+    def related(self, part_name, folder):
+        """The first part in *folder* that *part_name* relates to, or None."""
+        for name in (self.links(part_name) or {}).values():
+            if name.startswith(folder) and self._package.exists(name):
+                return name
+        return None
+
+    def fingerprint(self, part_name):
+        """Hash of the normalized XML of *part_name*, to match it across decks.
+
+        A slide master is hashed without its list of layouts and together
+        with its theme, a slide layout together with its master.
+        """
+        fingerprints = self._data['fingerprints']
+        if part_name not in fingerprints:
+            root = parse_xml(self._package.read(part_name), NORMALIZING_PARSER)
+            digest = hashlib.sha1()
+            if part_name.startswith(MASTERS_FOLDER):
+                for sldLayoutIdLst in root.findall('{%s}sldLayoutIdLst' % PRESENTATION_NS):
+                    root.remove(sldLayoutIdLst)
+                related = self.related(part_name, THEMES_FOLDER)
+            elif part_name.startswith(LAYOUTS_FOLDER):
+                related = self.related(part_name, MASTERS_FOLDER)
             else:
-                colors_id = "-1"
-                next_colors_id = "-1"
-
-            if xlsx_filename is not None:
-                xlsx_list = [x for x in os.listdir("{}/ppt/embeddings/".format(TEMP_FOLDER_TARGET))
-                               if '.xlsx' in x]
-                next_xlsx_id = len(xlsx_list) + 1
-                for index in range(len(xlsx_list)):
-                    if not any("Microsoft_Excel____{}.xlsx".format((index + 1)) in s for s in xlsx_list):
-                        next_xlsx_id = index + 1
-                        break
-                copyfile(xml_xlsx.format(TEMP_FOLDER_SOURCE, xlsx_id),
-                         xml_xlsx.format(TEMP_FOLDER_TARGET, next_xlsx_id))
+                related = None
+            digest.update(etree.tostring(root, method='c14n'))
+            if related is not None:
+                digest.update(self.fingerprint(related).encode('ascii'))
+            fingerprints[part_name] = digest.hexdigest()
+        return fingerprints[part_name]
+
+    def slide_parts(self, slide_number):
+        """Part names copied along with slide *slide_number*, the slide first."""
+        slides = self._data['slides']
+        key = str(slide_number)
+        if key not in slides:
+            parts = []
+            pending = ["ppt/slides/slide{}.xml".format(slide_number)]
+            while pending:
+                part_name = pending.pop()
+                if part_name in parts:
+                    continue
+                parts.append(part_name)
+                pending.extend(reversed(list((self.relations(part_name) or {}).values())))
+            slides[key] = parts
+        return slides[key]
+
+    def slide_content_types(self, slide_number):
+        """``{part name: ContentType}`` for the parts of slide *slide_number*."""
+        return OrderedDict((part_name, self.content_type(part_name))
+                           for part_name in self.slide_parts(slide_number))
+
+    def build(self):
+        """Resolve the parts of every slide of the deck."""
+        for name in self._package.names():
+            match = re.match(r'ppt/slides/slide(\d+)\.xml$', name)
+            if match:
+                self.slide_parts(int(match.group(1)))
+                layout = self.related(name, LAYOUTS_FOLDER)
+                if layout is not None:
+                    self.fingerprint(layout)
+        return self
+
+    @staticmethod
+    def cache_path(index_dir, path):
+        key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(index_dir, '{}.json'.format(key))
+
+    @classmethod
+    def cached(cls, package, index_dir):
+        """SourceIndex of *package* from *index_dir*, built and stored if stale.
+
+        A cached index is only used while the deck's path, mtime and size
+        match the ones it was built from.
+        """
+        stat = os.stat(package.path)
+        key = [os.path.abspath(package.path), stat.st_mtime, stat.st_size]
+        cache_path = cls.cache_path(index_dir, package.path)
+        try:
+            with open(cache_path) as file:
+                data = json.load(file, object_pairs_hook=OrderedDict)
+            if data.get('version') == INDEX_VERSION and data.get('key') == key:
+                return cls(package, data)
+        except (IOError, OSError, ValueError):
+            pass
+
+        index = cls(package).build()
+        index._data['key'] = key
+        # Other processes and threads may be storing indexes meanwhile.
+        os.makedirs(index_dir, exist_ok=True)
+        temp_path = '{}.{}-{}.tmp'.format(cache_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(index._data, file)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return index
+
+
+def open_source(path, index_dir=None, part_size_limit=0):
+    """Open source deck *path*; with *index_dir* its SourceIndex is cached there.
+
+    *path* may also be the bytes or a file object of the deck (see
+    Package), whose index is then never cached.
+    """
+    package = Package(path, part_size_limit)
+    if index_dir is not None and package.path is not None:
+        try:
+            package.index = SourceIndex.cached(package, index_dir)
+        except Exception:
+            package.close()
+            raise
+    return package
+
+
+class PackageCache(object):
+    """LRU cache of opened source decks for long-running processes.
+
+    A cached deck keeps its central directory, its SourceIndex (the parsed
+    [Content_Types].xml and .rels relations) and the inflated bytes of
+    parts up to *part_size_limit* bytes. At most *max_packages* decks are
+    kept and the least recently used ones are dropped once the estimated
+    memory exceeds *max_bytes*, which is checked whenever a deck is opened
+    or caches a part; parts that would not fit even then are not cached.
+    A deck whose mtime or size changed is reopened. A deck is opened (and
+    indexed) outside the cache's lock, so other decks can be served
+    meanwhile; concurrent requests for the same deck wait for that one
+    opening. Dropped decks are not closed by the cache, as copies may
+    still be reading them: their zip file is closed when the last
+    reference to them goes away.
+    """
+
+    def __init__(self, max_packages=32, max_bytes=256 * 1024 * 1024,
+                 part_size_limit=64 * 1024, index_dir=None):
+        self.max_packages = max_packages
+        self.max_bytes = max_bytes
+        self.part_size_limit = part_size_limit
+        self.index_dir = index_dir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._packages = OrderedDict()
+        self._opening = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._packages)
+
+    def get(self, path):
+        """The opened package of deck *path*."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._packages.pop(path, None)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                self._packages[path] = entry
+                return entry[1]
+            if entry is not None:
+                self.invalidations += 1
+            opening = self._opening.get((path, key))
+            if opening is None:
+                self.misses += 1
+                opening = self._opening[(path, key)] = Future()
+                opener = True
             else:
-                xlsx_id = "-1"
-                next_xlsx_id = "-1"
-
-            copyfile(xml_chart.format(TEMP_FOLDER_SOURCE, chart_id),
-                     xml_chart.format(TEMP_FOLDER_TARGET, next_chart_id))
-            copyfile(xml_chart_rel.format(TEMP_FOLDER_SOURCE, chart_id),
-                     xml_chart_rel.format(TEMP_FOLDER_TARGET, next_chart_id))
-
-            # NOTE: All files exist at this stage, now we start replacing them
-            #       with correct values/indexes.
-            # Step 9. Replace the id's in the chart relationship file
-            with open(xml_chart_rel.format(TEMP_FOLDER_TARGET, next_chart_id), 'r') as chart_rel:
-                xml_chart_rel_file = chart_rel.read()
-
-            # This is where the "-1" id whon't be found and thusly skipped.
-            xml_chart_rel_file = xml_chart_rel_file.replace(
-                'style{}.xml'.format(style_id),
-                'style{}.xml'.format(next_style_id)
-            ).replace(
-                'colors{}.xml'.format(colors_id),
-                'colors{}.xml'.format(next_colors_id)
-            ).replace(
-                'Microsoft_Excel_Worksheet{}.xlsx'.format(xlsx_id),
-                'Microsoft_Excel_Worksheet{}.xlsx'.format(next_xlsx_id)
-            )
-
-            with open(xml_chart_rel.format(TEMP_FOLDER_TARGET, next_chart_id), 'w') as chart_rel:
-                chart_rel.write(xml_chart_rel_file)
-
-            # Step 10. Replace the Target attribute in the slide#.xml.rel
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'r') as slide_rel:
-                xml_slide_rel_file = slide_rel.read()
-
-            xml_slide_rel_file = xml_slide_rel_file.replace(
-                'chart{}.xml'.format(chart_id),
-                'chart{}.xml'.format(next_chart_id)
-            )
-
-            with open(xml_slide_rel.format(TEMP_FOLDER_TARGET, next_slide_id), 'w') as slide_rel:
-                slide_rel.write(xml_slide_rel_file)
-
-            # Step 11. Add the chart lxml Element into the content_types container.
-            content_types.append(
-                etree.XML(
-                    '<Override PartName="/ppt/charts/chart{}.xml" ContentType="application/vnd.openxmlformats-officedocument.drawingml.chart+xml"/>'.format(
-                        next_chart_id
-                    )
-                )
-            )
-
-
-    # Step 12. Add the newly created content to the [Content_Types].xml file
-    tree = etree.parse('{}/[Content_Types].xml'.format(TEMP_FOLDER_TARGET))
-    root = tree.getroot()
-    for element in content_types:
-        root.append(element)
-
-    with open('{}/[Content_Types].xml'.format(TEMP_FOLDER_TARGET), 'w') as file:
-        # Hack :: Inject the top tag [<?xml ...] back into the file.
-        #         (Can't do it with lxml?)
-        file.writelines(
-            "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>{}".format(
-                etree.tostring(root)
-            )
-        )
-
-    treeT = etree.parse('{}/[Content_Types].xml'.format(TEMP_FOLDER_TARGET))
-    treeS = etree.parse('{}/[Content_Types].xml'.format(TEMP_FOLDER_SOURCE))
-    rootT = treeT.getroot()
-    rootS = treeS.getroot()
-    default_rootSLst = rootS.findall("*[@Extension]")
-
-    extensions_T = [el.attrib.get('Extension') for el in rootT.findall("*[@Extension]")]
-
-    for element in default_rootSLst:
-        if element.attrib["Extension"] not in extensions_T:
-            rootT.append(element)
-
-    with open('{}/[Content_Types].xml'.format(TEMP_FOLDER_TARGET), 'w') as file:
-        # Hack :: Inject the top tag [<?xml ...] back into the file.
-        #         (Can't do it with lxml?)
-        file.writelines(
-            "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>{}".format(
-                etree.tostring(rootT)
-            )
-        )
+                self.hits += 1
+                opener = False
+        if not opener:
+            return opening.result()
+
+        try:
+            package = open_source(path, self.index_dir, self.part_size_limit)
+            package.on_cache = self._cache_part
+            with self._lock:
+                self._packages[path] = (key, package)
+                self._evict()
+        except BaseException as error:
+            opening.set_exception(error)
+            raise
+        else:
+            opening.set_result(package)
+        finally:
+            # Whatever happened, the requests waiting for the deck are answered.
+            with self._lock:
+                self._opening.pop((path, key), None)
+        return package
+
+    def _cache_part(self, package, size):
+        # Package.on_cache of the cached decks: make room for *size* more bytes.
+        with self._lock:
+            self._evict(size)
+            return self.memory_size() + size <= self.max_bytes
+
+    def _evict(self, size=0):
+        # The most recently used package always stays.
+        while len(self._packages) > 1 and (
+                len(self._packages) > self.max_packages or
+                self.memory_size() + size > self.max_bytes):
+            self._packages.popitem(last=False)
+            self.evictions += 1
+
+    def memory_size(self):
+        return sum(package.memory_size() for key, package in self._packages.values())
+
+    def clear(self):
+        with self._lock:
+            self._packages.clear()
+
+    def stats(self):
+        with self._lock:
+            self._evict()
+            return {
+                'packages': len(self._packages),
+                'memory_size': self.memory_size(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+DRAWING_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+
+# 1 inch in EMU, the unit of the extents in DrawingML.
+EMU_PER_INCH = 914400
+
+
+def picture_extents(SOURCE, slide_name):
+    """``{part name: (cx, cy)}`` of the pictures slide *slide_name* shows.
+
+    The extent is the largest one in EMU the picture is shown at, scaled
+    through the groups it is in and widened by its cropping, i.e. the
+    size the whole image would have at the scale it is drawn at. Pictures
+    also used as a fill (no extent known) are left out.
+    """
+    if not SOURCE.exists(rels_name(slide_name)):
+        return {}
+    root = parse_xml(SOURCE.read(slide_name))
+    parts = dict((rel.get('Id'), resolve_target(slide_name, rel.get('Target')))
+                 for rel in Relationships(SOURCE.read(rels_name(slide_name))))
+
+    extents = {}
+    unknown = set()
+    for blip in root.iter('{%s}blip' % DRAWING_NS):
+        name = parts.get(blip.get('{%s}embed' % RELATIONSHIPS_NS))
+        if name is None:
+            continue
+        picture = blip.getparent().getparent()
+        ext = picture.find('{%s}spPr/{%s}xfrm/{%s}ext' % (PRESENTATION_NS, DRAWING_NS, DRAWING_NS))
+        if picture.tag != '{%s}pic' % PRESENTATION_NS or ext is None:
+            unknown.add(name)
+            continue
+        cx, cy = float(ext.get('cx')), float(ext.get('cy'))
+        for group in picture.iterancestors('{%s}grpSp' % PRESENTATION_NS):
+            xfrm = group.find('{%s}grpSpPr/{%s}xfrm' % (PRESENTATION_NS, DRAWING_NS))
+            if xfrm is None:
+                continue
+            group_ext = xfrm.find('{%s}ext' % DRAWING_NS)
+            child_ext = xfrm.find('{%s}chExt' % DRAWING_NS)
+            if group_ext is not None and child_ext is not None:
+                cx *= float(group_ext.get('cx')) / max(float(child_ext.get('cx')), 1.0)
+                cy *= float(group_ext.get('cy')) / max(float(child_ext.get('cy')), 1.0)
+        crop = blip.getparent().find('{%s}srcRect' % DRAWING_NS)
+        if crop is not None:
+            # Cropping offsets are in 1/1000 of a percent of the image.
+            shown_x = 1 - (int(crop.get('l', 0)) + int(crop.get('r', 0))) / 100000.0
+            shown_y = 1 - (int(crop.get('t', 0)) + int(crop.get('b', 0))) / 100000.0
+            cx /= max(shown_x, 0.01)
+            cy /= max(shown_y, 0.01)
+        previous = extents.get(name, (0, 0))
+        extents[name] = (max(previous[0], cx), max(previous[1], cy))
+    for name in unknown:
+        extents.pop(name, None)
+    return extents
+
+
+class MediaOptimizer(object):
+    """Downsamples copied pictures shown at more than *dpi* pixels per inch.
+
+    A JPEG or PNG picture of at least *min_size* bytes whose resolution
+    exceeds *dpi* at the extent it is shown at on the copied slide is
+    resized (and re-encoded in its own format, JPEG at *quality*) on a
+    pool of *workers* threads. The result is only used when it is
+    smaller. Results are kept by content hash and extent for the last
+    *cache_size* pictures, so copying the same slide again reuses them.
+    Needs Pillow.
+    """
+
+    def __init__(self, dpi=150, quality=85, min_size=32 * 1024, workers=4, cache_size=128):
+        if Image is None:
+            raise ImportError("media optimization needs Pillow (pip install Pillow)")
+        self.dpi = dpi
+        self.quality = quality
+        self.min_size = min_size
+        self.workers = workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def collect(self, pictures, SOURCE, slide_name, TARGET, copied):
+        """Add the pictures of a copied slide to ``{target part name: extent}``.
+
+        Only pictures copied from SOURCE that nothing else copied with the
+        slide relates to are candidates. A part used any other way, e.g.
+        deduplicated or shown by a vmlDrawing, is set to None (left alone);
+        a picture shown by several slides keeps its largest extent.
+        """
+        linked = set()
+        for source_name in copied:
+            if source_name != slide_name:
+                linked.update((SOURCE.index.links(source_name) or {}).values())
+        extents = picture_extents(SOURCE, slide_name)
+        for name, target_name in copied.items():
+            if not name.startswith('ppt/media/'):
+                continue
+            if (name in extents and name not in linked and
+                    TARGET.copied_from(target_name) == (SOURCE, name) and
+                    pictures.get(target_name, (0, 0)) is not None):
+                previous = pictures.get(target_name, (0, 0))
+                pictures[target_name] = (max(previous[0], extents[name][0]),
+                                         max(previous[1], extents[name][1]))
+            else:
+                pictures[target_name] = None
+
+    def apply(self, TARGET, pictures):
+        """Replace the *pictures* of TARGET (see :meth:`collect`) by smaller ones."""
+        trace = current_trace()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        futures = OrderedDict()
+        for name, extent in pictures.items():
+            if extent is None:
+                continue
+            data = TARGET.read(name)
+            if len(data) >= self.min_size:
+                futures[name] = (len(data), self._executor.submit(self.optimize, data, extent))
+        for name, (size, future) in futures.items():
+            data = future.result()
+            if data is not None:
+                TARGET.write(name, data)
+                trace.count('media_downsampled')
+                trace.count('media_bytes_saved', size - len(data))
+
+    def optimize(self, data, extent):
+        """The downsampled bytes of picture *data* shown at *extent*, or None."""
+        key = (hashlib.sha1(data).hexdigest(), extent)
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)
+                return self._cache[key]
+        result = self._optimize(data, extent)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _optimize(self, data, extent):
+        try:
+            image = Image.open(io.BytesIO(data))
+            if image.format not in ('JPEG', 'PNG'):
+                return None
+            width = extent[0] / EMU_PER_INCH * self.dpi
+            height = extent[1] / EMU_PER_INCH * self.dpi
+            scale = max(width / image.width, height / image.height)
+            if scale >= 1:
+                return None
+            format, info = image.format, image.info
+            if image.mode == 'P':
+                image = image.convert('RGBA')
+            image = image.resize((max(1, int(round(image.width * scale))),
+                                  max(1, int(round(image.height * scale)))), Image.LANCZOS)
+            options = dict((key, info[key]) for key in ('exif', 'icc_profile') if key in info)
+            if format == 'JPEG':
+                options['quality'] = self.quality
+            output = io.BytesIO()
+            image.save(output, format, optimize=True, **options)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+        result = output.getvalue()
+        return result if len(result) < len(data) else None
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class TargetLock(object):
+    """Advisory lock of a target deck, held while it is read and rewritten.
+
+    The lock is taken on a ``<path>.lock`` file next to the deck, which
+    (unlike the deck, see Package.save) is never replaced, and which is
+    left in place afterwards. It excludes other processes and threads
+    that lock the same deck. Waits for at most *timeout* seconds, if given,
+    before raising LockTimeout.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = '{}.lock'.format(path)
+        self.timeout = timeout
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        file = open(self.path, 'a+b')
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX |
+                                (fcntl.LOCK_NB if deadline is not None else 0))
+                else:
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except (IOError, OSError) as error:
+                if error.errno not in (errno.EACCES, errno.EAGAIN, errno.EDEADLK):
+                    file.close()
+                    raise
+                if deadline is not None and time.time() > deadline:
+                    file.close()
+                    raise LockTimeout('{} is locked'.format(self.path))
+                time.sleep(0.01)
+        self._file = file
+
+    def release(self):
+        file, self._file = self._file, None
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        file.close()
+
+
+class CommitQueue(object):
+    """Merges the copies queued for the same target into one rewrite.
+
+    :meth:`submit` queues slides to append to a target and returns a
+    Future. Every target is rewritten by one thread (of *workers*) at a
+    time, under its TargetLock; the copies queued meanwhile are all
+    applied by the next rewrite (group commit), so a busy target costs
+    one rewrite per batch instead of one per copy. If a merged rewrite
+    fails, its copies are retried one by one so that only the faulty
+    ones fail. *options* are passed on to copy_slides().
+    """
+
+    def __init__(self, workers=4, **options):
+        self.options = options
+        self.rewrites = 0
+        self._executor = ThreadPoolExecutor(workers)
+        self._pending = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def submit(self, target_path, slides, dedup=False):
+        """Queue the ``(copy_path, slide_number)`` *slides* for target_path.
+
+        The Future's result is a dict with the ``seconds`` of the rewrite
+        that applied them, the number of copies in its ``batch`` and its
+        ``trace`` report.
+        """
+        future = Future()
+        key = (os.path.abspath(target_path), dedup)
+        with self._lock:
+            self._pending.setdefault(key, []).append((list(slides), future))
+            if key not in self._running:
+                self._running.add(key)
+                self._executor.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                batch = self._pending.pop(key, None)
+                if not batch:
+                    self._running.discard(key)
+                    return
+            self._commit(key, batch)
+
+    def _commit(self, key, batch):
+        target_path, dedup = key
+        try:
+            result = self._rewrite(target_path, [slide for slides, future in batch for slide in slides],
+                                   dedup, len(batch))
+        except Exception:
+            if len(batch) == 1:
+                batch[0][1].set_exception(sys.exc_info()[1])
+                return
+            # copy_slides writes nothing when it fails, so each copy can be
+            # retried on its own to find the one(s) at fault.
+            for slides, future in batch:
+                try:
+                    future.set_result(self._rewrite(target_path, slides, dedup, 1))
+                except Exception:
+                    future.set_exception(sys.exc_info()[1])
+            return
+        # A dict of its own per copy: callers may update theirs.
+        for slides, future in batch:
+            future.set_result(dict(result))
+
+    def _rewrite(self, target_path, slides, dedup, batch):
+        start = time.time()
+        trace = CopyTrace()
+        copy_slides(target_path, slides, dedup, trace=trace, lock=True, **self.options)
+        with self._lock:
+            self.rewrites += 1
+        return {'seconds': time.time() - start, 'batch': batch, 'trace': trace.report()}
+
+
+def copy_part(SOURCE, source_name, TARGET, target_name, copied, dedup=False):
+    """Copy part *source_name* as *target_name* together with its relations.
+
+    Every part its .rels points at inside COPIED_FOLDERS is copied under a
+    free name as well (recursively, e.g. chart -> style/colors/xlsx and
+    vmlDrawing -> image) and the .rels is rewritten once to point at the
+    new names. *copied* maps the source part names copied so far to their
+    target names, so a part shared by several relations is copied once.
+    With *dedup*, a media or embedding part byte-identical to one already
+    in TARGET is pointed at instead of being copied again. Relations to
+    other parts already in *copied* (e.g. the slide layout mapped by
+    copy_layout(), or the slide a notesSlide belongs to) are pointed at
+    their target names too. Any other relation would point at an
+    unrelated part of TARGET, so ValueError is raised instead (e.g. for a
+    hyperlink to another slide); only the layouts of a copied slide
+    master are left to TargetSession.add_master(), which drops them.
+    """
+    copied[source_name] = target_name
+    TARGET.copy_part(SOURCE, source_name, target_name)
+    current_trace().count('parts_copied:' + posixpath.basename(posixpath.dirname(source_name)))
+
+    relations = SOURCE.index.relations(source_name)
+    if relations is None:
+        return
+    mapped = []
+    for target, part_name in SOURCE.index.links(source_name).items():
+        if target in relations:
+            continue
+        if part_name in copied:
+            mapped.append((target, part_name))
+        elif not (source_name.startswith(MASTERS_FOLDER) and part_name.startswith(LAYOUTS_FOLDER)):
+            raise ValueError('{} relates to {}, which cannot be copied along with it'.format(
+                source_name, part_name))
+    if not relations and not mapped:
+        # Nothing to renumber, copy it as is.
+        TARGET.copy_part(SOURCE, rels_name(source_name), rels_name(target_name))
+        return
+    rels = Relationships(SOURCE.read(rels_name(source_name)))
+    targets = {}
+    for target, part_name in relations.items():
+        if part_name not in copied and dedup and part_name.startswith(DEDUP_FOLDERS):
+            duplicate = TARGET.duplicates.find(SOURCE, part_name)
+            if duplicate is not None:
+                copied[part_name] = duplicate
+                current_trace().count('parts_shared:' + posixpath.basename(posixpath.dirname(part_name)))
+        if part_name not in copied:
+            copy_part(SOURCE, part_name, TARGET,
+                      TARGET.allocator.next_name(part_name), copied, dedup)
+        mapped.append((target, part_name))
+    for target, part_name in mapped:
+        if target.startswith('/'):
+            targets[target] = '/' + copied[part_name]
+        else:
+            targets[target] = relative_target(target_name, copied[part_name])
+    rels.remap(targets)
+    TARGET.write(rels_name(target_name), rels.serialize())
+
+
+def copy_notes_master(SOURCE, notes_master_name, TARGET, copied, dedup=False):
+    """Map notes master *notes_master_name* of SOURCE to the one of TARGET.
+
+    A presentation has a single notes master: the one of TARGET is used if
+    it has one, otherwise the master is copied, with its theme, and made
+    the notes master of TARGET. Its target name is recorded in *copied*.
+    """
+    session = TARGET.session
+    if session.notes_master is not None:
+        copied[notes_master_name] = session.notes_master
+        current_trace().count('parts_shared:notesMasters')
+        return
+    theme_name = SOURCE.index.related(notes_master_name, THEMES_FOLDER)
+    if theme_name is not None:
+        copy_part(SOURCE, theme_name, TARGET, TARGET.allocator.next_name(theme_name), copied, dedup)
+    copy_part(SOURCE, notes_master_name, TARGET,
+              TARGET.allocator.next_name(notes_master_name), copied, dedup)
+    session.add_notes_master(copied[notes_master_name])
+
+
+def copy_layout(SOURCE, layout_name, TARGET, copied, dedup=False):
+    """Map slide layout *layout_name* of SOURCE to a layout of TARGET.
+
+    A layout of TARGET with the same fingerprint (same XML, master and
+    theme) is reused. Otherwise the layout is copied, under the matching
+    master of TARGET or, when there is none, with its master and theme;
+    a copied master only keeps the layouts copied along with it. The
+    target name of the layout (and master) is recorded in *copied*.
+    """
+    session = TARGET.session
+    fingerprint = SOURCE.index.fingerprint(layout_name)
+    if fingerprint in session.layouts:
+        copied[layout_name] = session.layouts[fingerprint]
+        current_trace().count('parts_shared:slideLayouts')
+        return
+    master_name = SOURCE.index.related(layout_name, MASTERS_FOLDER)
+    if master_name is None:
+        return
+    master_fingerprint = SOURCE.index.fingerprint(master_name)
+    if master_fingerprint in session.masters:
+        copied[master_name] = session.masters[master_fingerprint]
+        current_trace().count('parts_shared:slideMasters')
+    else:
+        theme_name = SOURCE.index.related(master_name, THEMES_FOLDER)
+        if theme_name is not None:
+            copy_part(SOURCE, theme_name, TARGET,
+                      TARGET.allocator.next_name(theme_name), copied, dedup)
+        copy_part(SOURCE, master_name, TARGET,
+                  TARGET.allocator.next_name(master_name), copied, dedup)
+        session.add_master(copied[master_name], master_fingerprint)
+    copy_part(SOURCE, layout_name, TARGET,
+              TARGET.allocator.next_name(layout_name), copied, dedup)
+    session.add_layout(copied[master_name], copied[layout_name], fingerprint)
+
+
+class IntegrityError(Exception):
+    """The copy would leave the target inconsistent; see ``problems``."""
+
+    def __init__(self, problems):
+        Exception.__init__(self, '\n'.join(problems))
+        self.problems = problems
+
+
+def verify_parts(TARGET, names, content_types=None):
+    """Problems of parts *names* of TARGET, e.g. the ones a copy touched.
+
+    Checks that each of them has a content type and a single Override at
+    most, that the relations of each of them (and of each touched .rels)
+    have unique Ids and internal Targets that exist, and, if
+    presentation.xml or a slide master is among them, that the sldId,
+    sldMasterId and sldLayoutId ids are unique and in range, that every
+    sldId is in p:sldIdLst and relates to a slide and that every slide
+    related to has a sldId. *content_types* maps part names to the
+    content type they must have, e.g. the one their source gave them.
+    Only those parts are read, as a stream (see LeanPart), against the
+    part names of TARGET and its [Content_Types].xml.
+    """
+    problems = []
+    parts = set(TARGET.names())
+    names = [name for name in names if name in parts]
+    content_types = content_types or {}
+
+    # Content types: an Override or a Default for every part, the expected one
+    scan = LeanPart(TARGET, '[Content_Types].xml', LEAN_PARTS['[Content_Types].xml'])
+    overrides, counts = {}, {}
+    for attrib in scan.elements[OVERRIDE_PATH]:
+        overrides[attrib['PartName'][1:]] = attrib['ContentType']
+        counts[attrib['PartName'][1:]] = counts.get(attrib['PartName'][1:], 0) + 1
+    defaults = dict((attrib['Extension'].lower(), attrib['ContentType'])
+                    for attrib in scan.elements[DEFAULT_PATH])
+    for name in names:
+        if name == '[Content_Types].xml':
+            continue
+        if counts.get(name, 0) > 1:
+            problems.append('{}: {} Overrides'.format(name, counts[name]))
+        extension = posixpath.basename(name).rpartition('.')[2].lower()
+        content_type = overrides.get(name, defaults.get(extension))
+        if content_type is None:
+            problems.append('{}: no content type'.format(name))
+        elif name not in overrides and extension == 'xml' and not name.startswith('customXml/'):
+            # The xml Default is plain application/xml: wrong for any part of the deck
+            problems.append('{}: no Override'.format(name))
+        elif content_types.get(name) not in (None, content_type):
+            problems.append('{}: typed {}, not {}'.format(name, content_type, content_types[name]))
+
+    # Relationships: unique Ids, internal Targets that exist
+    rels_parts = set(name for name in names if name.endswith('.rels'))
+    rels_parts.update(rels_name(name) for name in names if rels_name(name) in parts)
+    relationships = {}
+    for name in sorted(rels_parts):
+        folder, filename = posixpath.split(name)
+        part_name = posixpath.join(posixpath.dirname(folder), filename[:-len('.rels')])
+        scan = LeanPart(TARGET, name, (RELATIONSHIP_PATH,))
+        ids = set()
+        for attrib in scan.elements[RELATIONSHIP_PATH]:
+            if attrib.get('Id') in ids:
+                problems.append('{}: duplicate Id {}'.format(name, attrib.get('Id')))
+            ids.add(attrib.get('Id'))
+            if attrib.get('TargetMode') == 'External':
+                continue
+            target = resolve_target(part_name, attrib.get('Target', ''))
+            if target not in parts:
+                problems.append('{}: {} points at missing part {}'.format(name, attrib.get('Id'), target))
+        relationships[part_name] = scan.elements[RELATIONSHIP_PATH]
+
+    # Slide, master and layout ids
+    if 'ppt/presentation.xml' in names or any(name.startswith(MASTERS_FOLDER) for name in names):
+        presentation = LeanPart(TARGET, 'ppt/presentation.xml',
+                                LEAN_PARTS['ppt/presentation.xml'] + (ANY_SLIDE_ID_PATH,))
+        if 'ppt/presentation.xml' not in relationships:
+            relationships['ppt/presentation.xml'] = LeanPart(
+                TARGET, 'ppt/_rels/presentation.xml.rels', (RELATIONSHIP_PATH,)
+            ).elements[RELATIONSHIP_PATH]
+        slide_rids = set(attrib.get('Id') for attrib in relationships['ppt/presentation.xml']
+                         if attrib.get('Type') == SLIDE_RELATIONSHIP)
+        slide_ids, rids = set(), set()
+        for attrib in presentation.elements[SLIDE_ID_PATH]:
+            id, rid = int(attrib['id']), attrib.get('{%s}id' % RELATIONSHIPS_NS)
+            if id in slide_ids or not MIN_SLIDE_ID <= id < MIN_LAYOUT_ID:
+                problems.append('ppt/presentation.xml: duplicate or invalid sldId {}'.format(id))
+            if rid in rids or rid not in slide_rids:
+                problems.append('ppt/presentation.xml: sldId {} relates to {}, not a '
+                                'slide of its own'.format(id, rid))
+            slide_ids.add(id)
+            rids.add(rid)
+        stray = len(presentation.elements[ANY_SLIDE_ID_PATH]) - len(presentation.elements[SLIDE_ID_PATH])
+        if stray:
+            problems.append('ppt/presentation.xml: {} sldId outside p:sldIdLst'.format(stray))
+        for rid in sorted(slide_rids - rids):
+            problems.append('ppt/presentation.xml: slide related as {} has no sldId'.format(rid))
+        layout_ids = [('ppt/presentation.xml', int(attrib['id'])) for attrib in
+                      presentation.elements[MASTER_ID_PATH]]
+        for name in sorted(parts):
+            if name.startswith(MASTERS_FOLDER) and name.endswith('.xml'):
+                scan = LeanPart(TARGET, name, (LAYOUT_ID_PATH,))
+                layout_ids.extend((name, int(attrib['id'])) for attrib in
+                                  scan.elements[LAYOUT_ID_PATH])
+        seen = set()
+        for name, id in layout_ids:
+            if id in seen or id < MIN_LAYOUT_ID:
+                problems.append('{}: duplicate or invalid master/layout id {}'.format(name, id))
+            seen.add(id)
+    return problems
+
+
+def copy_pptx_sheet(copy_path, slide_number, target_path, **options):
+    copy_slides(target_path, [(copy_path, slide_number)], **options)
+
+
+def copy_slides(target_path, slides, dedup=False, index_dir=None, cache=None,
+                policy=None, trace=None, output_path=None, media=None, memory=None,
+                lock=False, verify=False):
+    """Append each ``(copy_path, slide_number)`` of *slides* to target_path.
+
+    Every distinct source deck is opened once, all copies are applied to
+    the same in-memory target and the result is written once. The slides
+    are appended in the order given. With *dedup*, media and embeddings
+    identical to a part already in the target are shared, not copied.
+    With *index_dir*, the SourceIndex of every source deck is cached there.
+    With a PackageCache *cache*, the source decks are taken from (and left
+    open in) the cache instead. *policy* is the CompressionPolicy of the
+    parts written to the output. A CopyTrace *trace* records where the
+    time goes. With *output_path*, the result is written there and
+    target_path is left untouched. A MediaOptimizer *media* downsamples
+    the pictures of the copied slides. A MemoryBudget *memory* bounds the
+    memory used. The trace's ``peak_rss`` counter reports the peak memory
+    during the copy (see PeakRSS), or ``process_peak_rss`` the peak since
+    the process started where that is all that can be measured. With
+    *lock*, the deck written is held under its TargetLock meanwhile. With
+    *verify*, the parts the copy touched are checked by verify_parts()
+    and IntegrityError is raised instead of writing a broken deck.
+    """
+    if trace is not None:
+        with trace:
+            return copy_slides(target_path, slides, dedup, index_dir, cache, policy,
+                               output_path=output_path, media=media, memory=memory,
+                               lock=lock, verify=verify)
+    if lock:
+        target_lock = TargetLock(output_path or target_path)
+        with current_trace().step('lock'):
+            target_lock.acquire()
+        try:
+            return copy_slides(target_path, slides, dedup, index_dir, cache, policy,
+                               output_path=output_path, media=media, memory=memory,
+                               verify=verify)
+        finally:
+            target_lock.release()
+
+    with _copied_into(target_path, slides, dedup, index_dir, cache, media, memory,
+                      verify) as TARGET:
+        # Step 15. Write the package once: touched parts from memory, all
+        #          other entries copied raw from target_path and the sources.
+        with current_trace().step('write'):
+            TARGET.save(output_path or target_path, policy)
+
+
+def copy_slides_to(output, target, slides, dedup=False, cache=None, policy=None,
+                   trace=None, media=None, memory=None, verify=False):
+    """Stream *target* with *slides* appended to the writable *output*.
+
+    Like copy_slides(), but the target and the source decks of *slides*
+    may be paths, bytes or seekable binary file objects, and the result
+    only goes to ``output.write()`` (a BytesIO, a socket file, ...), which
+    needs no seek or tell. No file is written. Only source paths are taken
+    from the PackageCache *cache*.
+    """
+    if trace is not None:
+        with trace:
+            return copy_slides_to(output, target, slides, dedup, cache, policy,
+                                  media=media, memory=memory, verify=verify)
+
+    with _copied_into(target, slides, dedup, None, cache, media, memory, verify) as TARGET:
+        with current_trace().step('write'):
+            TARGET.write_to(output, policy)
+
+
+@contextmanager
+def _copied_into(target, slides, dedup, index_dir, cache, media=None, memory=None,
+                 verify=False):
+    """Open *target*, copy *slides* into it and yield it for writing.
+
+    The target and the source decks are kept open until the package is
+    written, as the parts that are not modified are copied raw from them.
+    """
+    trace = current_trace()
+
+    with PeakRSS() as rss:
+        # Step 1. Open the target & every source deck straight from their zip files
+        with trace.step('open'):
+            TARGET = Package(target, budget=memory)
+        sources = {}
+        uncached = []
+        pictures = {}
+        content_types = {}
+        try:
+            for source, slide_number in slides:
+                # File objects are told apart by identity, paths and bytes by value.
+                key = source if isinstance(source, (str, bytes)) else id(source)
+                if key not in sources:
+                    with trace.step('open'):
+                        if cache is not None and isinstance(source, str):
+                            sources[key] = cache.get(source)
+                        else:
+                            sources[key] = open_source(source, index_dir)
+                            uncached.append(sources[key])
+                copied = copy_slide(sources[key], slide_number, TARGET, dedup)
+                trace.count('slides_copied')
+                if verify:
+                    content_types.update((target_name, sources[key].index.content_type(source_name))
+                                         for source_name, target_name in copied.items())
+                if media is not None:
+                    with trace.step('media'):
+                        media.collect(pictures, sources[key], "ppt/slides/slide{}.xml".format(slide_number),
+                                      TARGET, copied)
+                if memory is not None:
+                    memory.check(cache, sources.values())
+
+            # Step 5. Downsample the pictures of the copied slides, all at once
+            if pictures:
+                with trace.step('media'):
+                    media.apply(TARGET, pictures)
+
+            # Step 6. Check every part the copies touched, before anything is written
+            if verify:
+                with trace.step('verify'):
+                    TARGET.session.commit()
+                    problems = verify_parts(TARGET, TARGET.modified_names(), content_types)
+                if problems:
+                    raise IntegrityError(problems)
+            yield TARGET
+        finally:
+            TARGET.close()
+            for SOURCE in uncached:
+                SOURCE.close()
+            peak = rss.current()
+            if peak is not None:
+                trace.maximum('peak_rss', peak)
+            else:
+                trace.maximum('process_peak_rss', peak_rss())
 
-    # Step 13. Find the next slide presentation relation id and add a new
-    #          relation to the presentation.xml.rels relationship file
-    tree = etree.parse('{}/ppt/_rels/presentation.xml.rels'.format(TEMP_FOLDER_TARGET))
-    root = tree.getroot()
-
-    relationship_list = root.findall("*[@Type='http://schemas.openxmlformats.org/officeDocument/2006/relationships/slide']")
-    relationship_count = len(relationship_list)
-    next_slide_rid = relationship_count + 2
-    for index in range(len(relationship_list)):
-        relationship_list[index] = int(relationship_list[index].attrib["Id"].replace("rId", ""))
-        
-    for index in range(len(relationship_list)):
-        if (index + 2) not in relationship_list:
-            next_slide_rid = index + 2
-            break
-
-    root.append(
-        etree.XML(
-            '<Relationship Id="rId{}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/slide" Target="slides/slide{}.xml"/>'.format(
-                next_slide_rid,
-                next_slide_id
-            )
-        )
-    )
-
-    tags = root.find("*[@Type='http://schemas.openxmlformats.org/officeDocument/2006/relationships/tags']")
-    tags_rId = int(tags.attrib['Id'].replace("rId", ''))
-    if next_slide_rid >= tags_rId:
-        new_tags_rId = next_slide_rid + 1
-        tags.attrib['Id'] = "rId{}".format(new_tags_rId)
-        new_presProps_rId = new_tags_rId + 1
-        root.find("*[@Type='http://schemas.openxmlformats.org/officeDocument/2006/relationships/presProps']").attrib['Id'] = "rId{}".format(new_presProps_rId)
-        new_viewProps_rId = new_presProps_rId + 1
-        root.find("*[@Type='http://schemas.openxmlformats.org/officeDocument/2006/relationships/viewProps']").attrib['Id'] = "rId{}".format(new_viewProps_rId)
-        new_theme_rId = new_viewProps_rId + 1
-        root.find("*[@Type='http://schemas.openxmlformats.org/officeDocument/2006/relationships/theme']").attrib['Id'] = "rId{}".format(new_theme_rId)
-        new_tableStyles_rId = new_theme_rId + 1
-        root.find("*[@Type='http://schemas.openxmlformats.org/officeDocument/2006/relationships/tableStyles']").attrib['Id'] = "rId{}".format(new_tableStyles_rId)
-
-    with open('{}/ppt/_rels/presentation.xml.rels'.format(TEMP_FOLDER_TARGET), 'w') as file:
-        # Hack :: Inject the top tag [<?xml ...] back into the file.
-        #         (Can't do it with lxml?)
-        file.writelines(
-            "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>{}".format(
-                etree.tostring(root)
-            )
-        )
 
-    # Step 14. Add the new relation id (from Step 13) and a new id to the
-    #          presentation.xml.
-    tree = etree.parse('{}/ppt/presentation.xml'.format(TEMP_FOLDER_TARGET))
-    root = tree.getroot()
-    sldIdLst = root.find(
-        './/p:sldIdLst',
-        {'p': "http://schemas.openxmlformats.org/presentationml/2006/main"}
-    )
-    sldId = deepcopy(sldIdLst.getchildren()[0])  # get the first child
-    sldId.attrib['id'] = unicode(max([int(x.attrib['id']) for x in sldIdLst]) + 1)
-    sldId.attrib['{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'] = "rId{}".format(next_slide_rid)
-    tags = root.find(
-        './/p:custDataLst',
-        {'p': "http://schemas.openxmlformats.org/presentationml/2006/main"}
-    )[0]
-    tags_rId = int(tags.attrib['{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'].replace("rId", ''))
-    if next_slide_rid >= tags_rId:
-        new_tags_rId = next_slide_rid + 1
-        tags.attrib['{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'] = "rId{}".format(new_tags_rId)
-
-    sldIdLst.append(sldId)
-
-    with open('{}/ppt/presentation.xml'.format(TEMP_FOLDER_TARGET), 'w') as file:
-        # Hack :: Inject the top tag [<?xml ...] back into the file.
-        #         (Can't do it with lxml?)
-        file.writelines(
-            "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>{}".format(
-                etree.tostring(root)
-            )
-        )
+def copy_slide(SOURCE, slide_number, TARGET, dedup=False):
+    """Copy slide *slide_number* of package SOURCE into package TARGET.
 
-    opc.repackage(TEMP_FOLDER_TARGET, target_path)
-    rmtree(TEMP_FOLDER_TARGET)
-    rmtree(TEMP_FOLDER_SOURCE)
+    Returns the ``{source part name: target part name}`` of the parts
+    the slide was copied with.
+    """
+    trace = current_trace()
 
-target_path = sys.argv[1]
-copy_path = sys.argv[2]
-copy_index = int(sys.argv[3])
+    # Step 2. Find the next_slide_id of target_path
+    with trace.step('next_id'):
+        next_slide_id = TARGET.allocator.next_id("ppt/slides/slide")
+
+    # Step 3. Point the slide at an identical slideLayout of target_path,
+    #         or copy the slideLayout (with its slideMaster and theme when
+    #         target_path has no identical slideMaster either). Its notes,
+    #         if any, get the notesMaster of target_path (or a copy).
+    xml_slide = "ppt/slides/slide{}.xml"
+    copied = OrderedDict()
+    with trace.step('layout'):
+        layout_name = SOURCE.index.related(xml_slide.format(slide_number), LAYOUTS_FOLDER)
+        if layout_name is not None:
+            copy_layout(SOURCE, layout_name, TARGET, copied, dedup)
+        notes_name = SOURCE.index.related(xml_slide.format(slide_number), NOTES_SLIDES_FOLDER)
+        if notes_name is not None:
+            notes_master_name = SOURCE.index.related(notes_name, NOTES_MASTERS_FOLDER)
+            if notes_master_name is not None:
+                copy_notes_master(SOURCE, notes_master_name, TARGET, copied, dedup)
+
+    # Step 4. Copy the oldslide, it's relationship and every oleObject,
+    #         image, vmlDrawing, chart (with its style, colors and xlsx),
+    #         notesSlide, SmartArt diagram, tag and comment part it relates
+    #         to. Each .rels is parsed once and its Targets are remapped to
+    #         the newly allocated part names in one pass.
+    with trace.step('copy_parts'):
+        copy_part(SOURCE, xml_slide.format(slide_number),
+                  TARGET, xml_slide.format(next_slide_id), copied, dedup)
+
+    # Step 11. Add the source Defaults for extensions the target lacks
+    session = TARGET.session
+    with trace.step('content_types'):
+        for extension, content_type in SOURCE.index.defaults.items():
+            session.add_default(extension, content_type)
+
+        # Step 12. Every copied part that has an Override in the source
+        #          [Content_Types].xml, or whose source Default differs from
+        #          the target's (e.g. ``bin``: oleObject vs printerSettings),
+        #          gets an Override under its new name (a deduplicated part
+        #          already has its own entry).
+        overrides = SOURCE.index.overrides
+        for source_name, target_name in copied.items():
+            content_type = SOURCE.index.content_type(source_name)
+            if source_name in overrides or (
+                    content_type and content_type != session.default_content_type(target_name)):
+                session.add_override(target_name, content_type)
+
+    # Step 13. Add a new slide relation to presentation.xml.rels
+    with trace.step('presentation_rels'):
+        rid = session.add_relationship('ppt/presentation.xml', SLIDE_RELATIONSHIP,
+                                       xml_slide.format(next_slide_id))
 
-copy_pptx_sheet(copy_path, copy_index, target_path)
-print("")
\ No newline at end of file
+    # Step 14. Add the new relation id (from Step 13) and a new id to the
+    #          presentation.xml. The core parts are serialized once, when
+    #          TARGET is written.
+    with trace.step('presentation'):
+        session.add_slide(rid)
+    return copied
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Copy slides from one or more decks to the end of a target deck.")
+    parser.add_argument('target_path')
+    parser.add_argument('copies', nargs='+', metavar='source.pptx slide_number',
+                        help="pairs of source deck and slide number, copied in order")
+    parser.add_argument('--dedup', action='store_true',
+                        help="share media/embeddings identical to ones already in the target")
+    parser.add_argument('--index-dir',
+                        help="cache the dependency index of every source deck in this folder")
+    parser.add_argument('--compression-level', type=int, default=zlib.Z_DEFAULT_COMPRESSION,
+                        help="zlib level (0-9) of the XML parts written")
+    parser.add_argument('--downsample-dpi', type=int,
+                        help="downsample copied pictures shown at more than this resolution "
+                             "(needs Pillow)")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help="keep the copy within this resident memory, failing otherwise")
+    parser.add_argument('--lock', action='store_true',
+                        help="hold an advisory lock on the target while updating it")
+    parser.add_argument('--verify', action='store_true',
+                        help="check the parts touched by the copy before writing the target")
+    parser.add_argument('--trace-report',
+                        help="write the per-step timings and counters as JSON to this file")
+    args = parser.parse_args()
+    if len(args.copies) % 2:
+        parser.error("copies must be pairs of source.pptx slide_number")
+
+    trace = CopyTrace() if args.trace_report else None
+    media = MediaOptimizer(args.downsample_dpi) if args.downsample_dpi else None
+    memory = MemoryBudget(int(args.memory_budget * 1048576)) if args.memory_budget else None
+    try:
+        copy_slides(args.target_path,
+                    [(args.copies[index], int(args.copies[index + 1]))
+                     for index in range(0, len(args.copies), 2)],
+                    args.dedup, args.index_dir,
+                    policy=CompressionPolicy(level=args.compression_level), trace=trace,
+                    media=media, memory=memory, lock=args.lock, verify=args.verify)
+    finally:
+        if media is not None:
+            media.close()
+    if trace is not None:
+        trace.write_report(args.trace_report)
+    print("")
@@ -0,0 +1,13 @@
+"""The modules under test are scripts at the root of the repository."""
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def source(tmp_path):
+    """Path of a three-slide deck, S1 to S3, each showing the same picture."""
+    from decks import make_pptx, png, write
+    return write(tmp_path, 'source.pptx', make_pptx(['S1', 'S2', 'S3'], picture=png(200, 0, 0)))
@@ -0,0 +1,178 @@
+"""Decks built with python-pptx, and a structural check of copied decks."""
+import io, re, struct, zlib, zipfile, posixpath
+
+import pytest
+from lxml import etree
+
+pptx = pytest.importorskip('pptx')
+from pptx.util import Inches
+
+NS = {
+    'p': 'http://schemas.openxmlformats.org/presentationml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'ct': 'http://schemas.openxmlformats.org/package/2006/content-types',
+    'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+}
+SECTIONS = (
+    '<p:extLst><p:ext uri="{{521415D9-36F7-43E2-AB2F-B90AF26B5E84}}">'
+    '<p14:sectionLst xmlns:p14="http://schemas.microsoft.com/office/powerpoint/2010/main">'
+    '<p14:section name="Section" id="{{4F4C3B2A-1D0E-4F5A-9B8C-7D6E5F4A3B2C}}">'
+    '<p14:sldIdLst>{}</p14:sldIdLst></p14:section></p14:sectionLst></p:ext></p:extLst>'
+)
+
+
+def png(red, green, blue, size=8):
+    """A *size* x *size* PNG of one colour."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    rows = b''.join(b'\x00' + bytes(bytearray([red, green, blue])) * size for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def make_pptx(titles=(), layout=1, picture=None, theme=None, sections=False, notes=False,
+              jump=False):
+    """Bytes of a python-pptx deck with one slide per title.
+
+    The slides use slide layout *layout* and show *picture* (PNG bytes);
+    with *notes*, each has the notes "notes <title>"; with *jump*, the
+    title of the last slide links to the first slide. *theme* renames the
+    theme, which makes the slide master a different one; with *sections*,
+    all the slides are in one p14 section.
+    """
+    deck = pptx.Presentation()
+    for title in titles:
+        slide = deck.slides.add_slide(deck.slide_layouts[layout])
+        slide.shapes.title.text = title
+        if picture is not None:
+            slide.shapes.add_picture(io.BytesIO(picture), Inches(1), Inches(1))
+        if notes:
+            slide.notes_slide.notes_text_frame.text = 'notes ' + title
+    if jump:
+        deck.slides[-1].shapes.title.click_action.target_slide = deck.slides[0]
+    output = io.BytesIO()
+    deck.save(output)
+    if theme is None and not sections:
+        return output.getvalue()
+
+    source = zipfile.ZipFile(output)
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as result:
+        for info in source.infolist():
+            data = source.read(info.filename)
+            if theme is not None and info.filename == 'ppt/theme/theme1.xml':
+                data = data.replace(b'name="Office Theme"', 'name="{}"'.format(theme).encode('utf-8'))
+            if sections and info.filename == 'ppt/presentation.xml':
+                ids = ''.join('<p14:sldId id="{}"/>'.format(id.decode('ascii'))
+                              for id in re.findall(br'<p:sldId id="(\d+)"', data))
+                data = data.replace(b'</p:presentation>',
+                                    SECTIONS.format(ids).encode('utf-8') + b'</p:presentation>')
+            result.writestr(info, data)
+    return output.getvalue()
+
+
+def write(folder, name, data):
+    """Write deck *data* as *name* in pathlib *folder*; return its path."""
+    path = folder / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def open_deck(data):
+    return pptx.Presentation(io.BytesIO(data))
+
+
+def titles(data):
+    return [slide.shapes.title.text for slide in open_deck(data).slides]
+
+
+def notes(data):
+    """The notes of every slide of deck *data*, None for a slide without."""
+    return [slide.notes_slide.notes_text_frame.text if slide.has_notes_slide else None
+            for slide in open_deck(data).slides]
+
+
+def parts(data, folder):
+    """Names of the parts of deck *data* in *folder*."""
+    return sorted(name for name in zipfile.ZipFile(io.BytesIO(data)).namelist()
+                  if name.startswith(folder) and '/_rels/' not in name)
+
+
+def content_type(data, name):
+    """The content type part *name* of deck *data* gets."""
+    types = etree.fromstring(zipfile.ZipFile(io.BytesIO(data)).read('[Content_Types].xml'))
+    for override in types.iterfind('ct:Override', NS):
+        if override.get('PartName') == '/' + name:
+            return override.get('ContentType')
+    for default in types.iterfind('ct:Default', NS):
+        if default.get('Extension').lower() == name.rpartition('.')[2].lower():
+            return default.get('ContentType')
+    return None
+
+
+def check_deck(data):
+    """Check the package structure of deck *data*; return it opened by python-pptx.
+
+    Every relationship target exists and relationship Ids are unique, every
+    part has a content type and every Override a part, the sldIds are all
+    in p:sldIdLst, unique and each relates to a slide of its own, every
+    notesSlide relates back to the one slide that relates to it, and the
+    sldMasterId/sldLayoutId ids are unique.
+    """
+    package = zipfile.ZipFile(io.BytesIO(data))
+    assert package.testzip() is None
+    names = set(package.namelist())
+    related = {}
+
+    types = etree.fromstring(package.read('[Content_Types].xml'))
+    overrides = set(override.get('PartName')[1:] for override in types.iterfind('ct:Override', NS))
+    defaults = set(default.get('Extension').lower() for default in types.iterfind('ct:Default', NS))
+    assert overrides <= names, overrides - names
+    for name in names - {'[Content_Types].xml'}:
+        assert name in overrides or posixpath.basename(name).rpartition('.')[2].lower() in defaults, name
+        if not name.endswith('.rels'):
+            continue
+        folder, filename = posixpath.split(name)
+        part_name = posixpath.join(posixpath.dirname(folder), filename[:-len('.rels')])
+        relationships = etree.fromstring(package.read(name)).findall('rel:Relationship', NS)
+        ids = [relationship.get('Id') for relationship in relationships]
+        assert len(set(ids)) == len(ids), name
+        for relationship in relationships:
+            if relationship.get('TargetMode') == 'External':
+                continue
+            target = relationship.get('Target')
+            target = target[1:] if target.startswith('/') else posixpath.normpath(
+                posixpath.join(posixpath.dirname(part_name), target))
+            assert target in names, (name, target)
+            related.setdefault(part_name, []).append(target)
+
+    presentation = etree.fromstring(package.read('ppt/presentation.xml'))
+    slide_ids = presentation.findall('p:sldIdLst/p:sldId', NS)
+    assert len(slide_ids) == len(presentation.findall('.//p:sldId', NS))
+    assert len(set(slide_id.get('id') for slide_id in slide_ids)) == len(slide_ids)
+    slides = dict((relationship.get('Id'), relationship.get('Target')) for relationship in
+                  etree.fromstring(package.read('ppt/_rels/presentation.xml.rels'))
+                  if relationship.get('Type').endswith('/slide'))
+    rids = [slide_id.get('{%s}id' % NS['r']) for slide_id in slide_ids]
+    assert sorted(rids) == sorted(slides)
+
+    for name in names:
+        if re.match(r'ppt/slides/slide\d+\.xml$', name):
+            for notes_name in related.get(name, ()):
+                if notes_name.startswith('ppt/notesSlides/'):
+                    slides = [target for target in related[notes_name] if target.startswith('ppt/slides/')]
+                    assert slides == [name], (notes_name, slides)
+
+    layout_ids = [element.get('id') for element in presentation.iterfind('p:sldMasterIdLst/p:sldMasterId', NS)]
+    for name in names:
+        if re.match(r'ppt/slideMasters/slideMaster\d+\.xml$', name):
+            master = etree.fromstring(package.read(name))
+            layout_ids.extend(element.get('id') for element in
+                              master.iterfind('p:sldLayoutIdLst/p:sldLayoutId', NS))
+    assert len(set(layout_ids)) == len(layout_ids)
+
+    deck = open_deck(data)
+    assert len(deck.slides) == len(slide_ids)
+    return deck
@@ -0,0 +1,15 @@
+from bulk_copy import run_jobs
+from decks import check_deck, make_pptx, titles, write
+
+
+def test_bulk_jobs_per_target(tmp_path, source):
+    first = write(tmp_path, 'first.pptx', make_pptx(['F1']))
+    second = write(tmp_path, 'second.pptx', make_pptx(['E1']))
+    report = run_jobs([(first, source, 2), (second, source, 1), (first, source, 9),
+                       (first, source, 3)], workers=2)
+    assert report['summary']['jobs'] == 4
+    assert [job['ok'] for job in report['jobs']] == [True, True, False, True]
+    for path, expected in [(first, ['F1', 'S2', 'S3']), (second, ['E1', 'S1'])]:
+        data = open(path, 'rb').read()
+        check_deck(data)
+        assert titles(data) == expected
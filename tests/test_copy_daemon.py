@@ -0,0 +1,67 @@
+import os, errno, shutil, socket, tempfile, threading
+
+import pytest
+
+from decks import make_pptx, titles, write
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason="needs Unix domain sockets")
+
+
+@pytest.fixture
+def socket_path():
+    folder = tempfile.mkdtemp(prefix='copy_daemon_')  # short enough for a socket path
+    yield os.path.join(folder, 'copy.sock')
+    shutil.rmtree(folder)
+
+
+@pytest.fixture
+def server(socket_path):
+    from copy_daemon import CopyServer
+    server = CopyServer(socket_path, workers=2, verify=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_daemon_serves_copies(tmp_path, source, server):
+    from copy_daemon import send_requests
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1']))
+    output = str(tmp_path / 'output.pptx')
+    responses = send_requests(server.socket_path, [
+        {'source': source, 'slide': 2, 'target': target},
+        {'source': source, 'slide': 3, 'target': target, 'output': output},
+        {'source': source, 'slide': 9, 'target': target},
+        {'command': 'stats'},
+    ])
+    assert [response['ok'] for response in responses] == [True, True, False, True]
+    assert 'verify' in responses[0]['trace']['steps']
+    assert responses[3]['requests'] == 2
+    assert titles(open(target, 'rb').read()) == ['T1', 'S2']
+    assert titles(open(output, 'rb').read()) == ['T1', 'S2', 'S3']
+
+
+def test_daemon_replaces_only_stale_sockets(socket_path):
+    from copy_daemon import CopyServer
+    with open(socket_path, 'w') as file:
+        file.write('not a socket')
+    with pytest.raises(FileExistsError):
+        CopyServer(socket_path)
+    assert open(socket_path).read() == 'not a socket'
+
+    os.remove(socket_path)
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    CopyServer(socket_path).server_close()
+    assert not os.path.exists(socket_path)
+
+
+def test_daemon_does_not_take_over_a_served_socket(server):
+    from copy_daemon import CopyServer, send_requests
+    with pytest.raises(OSError) as error:
+        CopyServer(server.socket_path)
+    assert error.value.errno == errno.EADDRINUSE
+    assert send_requests(server.socket_path, [{'command': 'stats'}])[0]['ok']
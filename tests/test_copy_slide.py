@@ -0,0 +1,386 @@
+import io, os, threading, time, zipfile
+
+import pytest
+from lxml import etree
+
+import benchmark
+import copy_slide
+from copy_slide import (CommitQueue, CopyTrace, IntegrityError, LockTimeout, MemoryBudget, Package,
+                        PackageCache, PeakRSS, SourceIndex, TargetLock, copy_slides, copy_slides_to,
+                        open_source, verify_parts)
+from decks import check_deck, content_type, make_pptx, notes, parts, png, titles, write
+
+
+def copied(target, slides, **options):
+    output = io.BytesIO()
+    copy_slides_to(output, target, slides, **options)
+    return output.getvalue()
+
+
+OLE_OBJECT = 'application/vnd.openxmlformats-officedocument.oleObject'
+
+
+def test_copy_one_slide(tmp_path, source):
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1', 'T2']))
+    copy_slides(target, [(source, 2)])
+    data = open(target, 'rb').read()
+    check_deck(data)
+    assert titles(data) == ['T1', 'T2', 'S2']
+    assert len(parts(data, 'ppt/media/')) == 1
+
+
+def test_copy_several_slides_in_order(tmp_path, source):
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1']))
+    output = str(tmp_path / 'output.pptx')
+    copy_slides(target, [(source, 3), (source, 1), (source, 3)], output_path=output)
+    data = open(output, 'rb').read()
+    check_deck(data)
+    assert titles(data) == ['T1', 'S3', 'S1', 'S3']
+    assert titles(open(target, 'rb').read()) == ['T1']
+
+
+def test_notes_are_copied_with_the_slide(tmp_path):
+    source = make_pptx(['S1', 'S2'], notes=True)
+    # No notes master in the target: it is copied along.
+    data = copied(make_pptx(['T1']), [(source, 2), (source, 1)], verify=True)
+    check_deck(data)
+    assert notes(data) == [None, 'notes S2', 'notes S1']
+    assert len(parts(data, 'ppt/notesMasters/')) == 1
+
+    # Notes of the target keep theirs, copies get their own.
+    target = make_pptx(['T1', 'T2', 'T3'], notes=True)
+    data = copied(target, [(source, 1)], verify=True)
+    check_deck(data)
+    assert notes(data) == ['notes T1', 'notes T2', 'notes T3', 'notes S1']
+    assert parts(data, 'ppt/notesMasters/') == parts(target, 'ppt/notesMasters/')
+
+
+def test_relation_that_cannot_be_copied_fails(source):
+    with pytest.raises(ValueError):
+        copied(make_pptx(['T1']), [(make_pptx(['S1', 'S2'], jump=True), 2)])
+
+
+def test_embedding_keeps_its_source_content_type(tmp_path):
+    # The target's "bin" Default is printerSettings, the source's oleObject.
+    source = str(tmp_path / 'synthetic.pptx')
+    benchmark.make_deck(source, slides=1, images=1, charts=1, ole_objects=1, vml_drawings=1)
+    data = copied(make_pptx(['T1']), [(source, 1)], verify=True)
+    check_deck(data)
+    assert content_type(data, 'ppt/embeddings/oleObject1.bin') == OLE_OBJECT
+
+
+def test_dedup_shares_identical_media(source):
+    target = make_pptx(['T1'], picture=png(200, 0, 0))
+    assert len(parts(copied(target, [(source, 1), (source, 2)]), 'ppt/media/')) == 3
+
+    data = copied(target, [(source, 1), (source, 2)], dedup=True)
+    check_deck(data)
+    assert parts(data, 'ppt/media/') == parts(target, 'ppt/media/')
+
+
+def test_index_dir_is_shared_by_concurrent_builders(tmp_path, source, monkeypatch):
+    index_dir = str(tmp_path / 'indexes' / 'fresh')
+    errors = []
+
+    def build():
+        try:
+            open_source(source, index_dir).close()
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=build) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert [name for name in os.listdir(index_dir) if name.endswith('.tmp')] == []
+
+    # The stored index is used while the deck is unchanged.
+    monkeypatch.setattr(SourceIndex, 'build', lambda self: pytest.fail('index rebuilt'))
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1']))
+    copy_slides(target, [(source, 2)], index_dir=index_dir)
+    assert titles(open(target, 'rb').read()) == ['T1', 'S2']
+
+
+def slow_open_source(monkeypatch, slow_path, error=None):
+    """Make open_source() take half a second for *slow_path* (then raise *error*)."""
+    open_source = copy_slide.open_source
+    opened = []
+
+    def slow_open(path, *args):
+        opened.append(path)
+        if path == slow_path:
+            time.sleep(0.5)
+            if error is not None:
+                raise error
+        return open_source(path, *args)
+    monkeypatch.setattr(copy_slide, 'open_source', slow_open)
+    return opened
+
+
+def run_threads(count, function):
+    results = []
+
+    def run():
+        try:
+            results.append(function())
+        except Exception as error:
+            results.append(error)
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_package_cache_opens_outside_its_lock(tmp_path, source, monkeypatch):
+    slow = write(tmp_path, 'slow.pptx', make_pptx(['L1']))
+    opened = slow_open_source(monkeypatch, slow)
+    cache = PackageCache()
+    cache.get(source)
+    threads, results = run_threads(3, lambda: cache.get(slow))
+    time.sleep(0.1)
+    start = time.time()
+    cache.get(source)
+    assert time.time() - start < 0.25
+    for thread in threads:
+        thread.join()
+    assert opened.count(slow) == 1
+    assert results[0] is results[1] is results[2]
+    assert cache.stats()['misses'] == 2
+
+
+def test_package_cache_answers_waiters_when_opening_fails(tmp_path, monkeypatch):
+    broken = write(tmp_path, 'broken.pptx', make_pptx(['B1']))
+    slow_open_source(monkeypatch, broken, IOError('unreadable'))
+    cache = PackageCache()
+    threads, results = run_threads(3, lambda: cache.get(broken))
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert [type(result) for result in results] == [IOError] * 3
+    monkeypatch.undo()
+    assert cache.get(broken).names()
+
+
+def test_package_cache_memory_size_while_parts_are_read(source):
+    cache = PackageCache(part_size_limit=1 << 20)
+    package = cache.get(source)
+    names = package.names()
+    stop = []
+
+    def read():
+        while not stop:
+            package.clear_cache()
+            for name in names:
+                package.read(name)
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for _ in range(5000):
+            cache.memory_size()
+    finally:
+        stop.append(True)
+        reader.join()
+
+
+def test_package_cache_stays_within_max_bytes(tmp_path, source):
+    other = write(tmp_path, 'other.pptx', make_pptx(['O1', 'O2'], picture=png(0, 0, 200)))
+    cache = PackageCache(max_bytes=64 * 1024, part_size_limit=1 << 20)
+    for path in [source, other, source, other]:
+        package = cache.get(path)
+        for name in package.names():
+            package.read(name)
+        assert cache.memory_size() <= cache.max_bytes
+    assert cache.stats()['evictions'] >= 3
+
+
+def test_copy_into_empty_target(source):
+    # python-pptx writes a deck without slides with no p:sldIdLst at all.
+    data = copied(make_pptx(), [(source, 1), (source, 2)])
+    check_deck(data)
+    assert titles(data) == ['S1', 'S2']
+
+
+def test_in_memory_decks(tmp_path, source):
+    source_data = open(source, 'rb').read()
+    before = sorted(tmp_path.iterdir())
+    data = copied(make_pptx(['T1']), [(source_data, 2), (io.BytesIO(source_data), 3)])
+    check_deck(data)
+    assert titles(data) == ['T1', 'S2', 'S3']
+    assert sorted(tmp_path.iterdir()) == before
+
+
+def test_same_template_reuses_layout(source):
+    target = make_pptx(['T1'])
+    data = copied(target, [(source, 1)])
+    deck = check_deck(data)
+    assert parts(data, 'ppt/slideLayouts/') == parts(target, 'ppt/slideLayouts/')
+    assert parts(data, 'ppt/slideMasters/') == parts(target, 'ppt/slideMasters/')
+    assert deck.slides[1].slide_layout.name == 'Title and Content'
+
+
+def test_other_template_copies_master_once():
+    source = make_pptx(['S1', 'S2'], theme='Other Theme')
+    target = make_pptx(['T1'])
+    data = copied(target, [(source, 1), (source, 2)])
+    deck = check_deck(data)
+    assert len(parts(data, 'ppt/slideMasters/')) == 2
+    assert len(parts(data, 'ppt/theme/')) == 2
+    # Only the layout the slides use comes along with the master.
+    assert len(parts(data, 'ppt/slideLayouts/')) == len(parts(target, 'ppt/slideLayouts/')) + 1
+    layouts = [slide.slide_layout for slide in deck.slides]
+    assert layouts[1] == layouts[2] != layouts[0]
+    assert layouts[1].slide_master != layouts[0].slide_master
+    assert len(layouts[1].slide_master.slide_layouts) == 1
+
+
+def test_other_layout_of_same_template_is_reused():
+    source = make_pptx(['S1'], layout=5)
+    data = copied(make_pptx(['T1']), [(source, 1)])
+    deck = check_deck(data)
+    assert deck.slides[1].slide_layout.name == 'Title Only'
+    assert deck.slides[1].slide_layout == deck.slide_layouts[5]
+
+
+@pytest.mark.parametrize('sections', [False, True])
+def test_memory_mode_writes_what_tree_mode_does(source, sections):
+    target = make_pptx(['T1', 'T2'], sections=sections)
+    slides = [(source, 1), (make_pptx(['O1'], theme='Other Theme'), 1)]
+    tree = copied(target, slides)
+    lean = copied(target, slides, memory=MemoryBudget(1 << 40, large_xml=1))
+    check_deck(lean)
+    assert titles(lean) == ['T1', 'T2', 'S1', 'O1']
+    for name in ['[Content_Types].xml', 'ppt/presentation.xml', 'ppt/_rels/presentation.xml.rels']:
+        assert (etree.tostring(etree.fromstring(zipfile.ZipFile(io.BytesIO(tree)).read(name)), method='c14n') ==
+                etree.tostring(etree.fromstring(zipfile.ZipFile(io.BytesIO(lean)).read(name)), method='c14n'))
+
+
+def test_memory_mode_into_empty_target(source):
+    data = copied(make_pptx(), [(source, 1)], memory=MemoryBudget(1 << 40, large_xml=1))
+    check_deck(data)
+    assert titles(data) == ['S1']
+
+
+def test_memory_budget_exceeded(source):
+    with pytest.raises(MemoryError):
+        copied(make_pptx(['T1']), [(source, 1)], memory=MemoryBudget(1))
+
+
+def test_peak_rss_is_restarted_per_copy_only(source, monkeypatch):
+    resets = []
+    monkeypatch.setattr(copy_slide, 'reset_peak_rss', lambda: resets.append(1) or True)
+    trace = CopyTrace()
+    copied(make_pptx(['T1']), [(source, 1)], trace=trace)
+    assert len(resets) == 1
+    assert trace.counters['peak_rss'] > 0
+
+    # An overlapping copy must not restart the peak of the one running.
+    with PeakRSS() as outer:
+        copied(make_pptx(['T1']), [(source, 1)])
+    assert len(resets) == 2
+    assert outer.peak > 0
+
+    # Where the peak cannot be restarted, it is labelled as the process one.
+    monkeypatch.setattr(copy_slide, 'reset_peak_rss', lambda: False)
+    trace = CopyTrace()
+    copied(make_pptx(['T1']), [(source, 1)], trace=trace)
+    assert 'peak_rss' not in trace.counters
+    assert trace.counters['process_peak_rss'] > 0
+
+
+def test_commit_queue_merges_concurrent_copies(tmp_path, source):
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1']))
+    queue = CommitQueue(2)
+    try:
+        futures = [queue.submit(target, [(source, number % 3 + 1)]) for number in range(12)]
+        results = [future.result(timeout=30) for future in futures]
+    finally:
+        queue.close()
+    data = open(target, 'rb').read()
+    check_deck(data)
+    assert sorted(titles(data)[1:]) == sorted('S{}'.format(number % 3 + 1) for number in range(12))
+    assert queue.rewrites < 12
+    assert sum(result['batch'] for result in results) >= 12
+    # Copies applied by the same rewrite still get a result of their own.
+    assert len(set(map(id, results))) == 12
+
+
+def test_commit_queue_isolates_failing_copy(tmp_path, source):
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1']))
+    queue = CommitQueue(1)
+    try:
+        futures = [queue.submit(target, [(source, 1)]), queue.submit(target, [(source, 9)]),
+                   queue.submit(target, [(source, 2)])]
+        for future in futures:
+            future.exception(timeout=30)
+    finally:
+        queue.close()
+    assert [future.exception() is None for future in futures] == [True, False, True]
+    assert titles(open(target, 'rb').read()) == ['T1', 'S1', 'S2']
+
+
+def test_target_lock_excludes_other_holders(tmp_path):
+    target = str(tmp_path / 'target.pptx')
+    with TargetLock(target):
+        with pytest.raises(LockTimeout):
+            TargetLock(target, timeout=0.2).acquire()
+    with TargetLock(target, timeout=0.2):
+        pass
+
+
+def test_verify_passes_copies(source):
+    for target in [make_pptx(), make_pptx(['T1'], sections=True)]:
+        check_deck(copied(target, [(source, 1), (make_pptx(['O1'], theme='Other'), 1)],
+                          dedup=True, verify=True))
+
+
+def corrupt(data, name, old, new):
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as package, \
+            zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as result:
+        for info in package.infolist():
+            part = package.read(info.filename)
+            if info.filename == name:
+                assert old in part
+                part = part.replace(old, new, 1)
+            result.writestr(info, part)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('name, old, new, problem', [
+    ('ppt/slides/_rels/slide2.xml.rels', b'Target="../media/', b'Target="../media/missing-', 'missing part'),
+    ('ppt/slides/_rels/slide2.xml.rels', b'Id="rId2"', b'Id="rId1"', 'duplicate Id'),
+    ('[Content_Types].xml', b'PartName="/ppt/slides/slide2.xml"', b'PartName="/ppt/slides/other.xml"',
+     'no Override'),
+    ('ppt/presentation.xml', b'<p:sldId id="257"', b'<p:sldId id="256"', 'sldId 256'),
+])
+def test_verify_reports_problems(source, name, old, new, problem):
+    data = corrupt(copied(make_pptx(['T1']), [(source, 1)]), name, old, new)
+    problems = verify_parts(Package(data), ['ppt/slides/slide2.xml', 'ppt/presentation.xml',
+                                            'ppt/slides/_rels/slide2.xml.rels'])
+    assert any(problem in line for line in problems), problems
+
+
+def test_verify_reports_sldid_outside_sldidlst(source):
+    data = copied(make_pptx(['T1'], sections=True), [(source, 1)])
+    data = corrupt(data, 'ppt/presentation.xml', b'<p:sldId id="257" r:id="rId8"/>', b'')
+    data = corrupt(data, 'ppt/presentation.xml', b'</p14:sldIdLst>',
+                   b'<p:sldId id="257" r:id="rId8"/></p14:sldIdLst>')
+    problems = verify_parts(Package(data), ['ppt/presentation.xml'])
+    assert any('outside p:sldIdLst' in line for line in problems), problems
+
+
+def test_verify_reports_wrong_content_type(source):
+    data = copied(make_pptx(['T1']), [(source, 1)])
+    problems = verify_parts(Package(data), ['ppt/slides/slide2.xml'],
+                            {'ppt/slides/slide2.xml': OLE_OBJECT})
+    assert any('typed' in line for line in problems), problems
+
+
+def test_verify_failure_writes_nothing(tmp_path, source, monkeypatch):
+    monkeypatch.setattr(copy_slide, 'verify_parts', lambda *args: ['broken'])
+    target = write(tmp_path, 'target.pptx', make_pptx(['T1']))
+    before = open(target, 'rb').read()
+    with pytest.raises(IntegrityError):
+        copy_slides(target, [(source, 1)], verify=True)
+    assert open(target, 'rb').read() == before